@@ -2,11 +2,22 @@ import discord
 import os
 from discord.ext import commands
 import asyncio
+import atexit
 import logging
 
+from bot import settings
+from mixins.config import close_store
+from tft.executor import configure_executor, shutdown_executor
+from tft.history import HistoryStore
+from tft.http import create_session
+from tft.metrics import start_metrics_server, discord_rate_limit_trace
+from tft.scheduler import PollScheduler
+from tft.services import set_parser_backend
+
 log = logging.getLogger(__name__)
 
 extensions = (
+    'bot.scheduler',
     'bot.leaderboard',
     'bot.competition',
     'bot.cronannouncements.cog',
@@ -15,7 +26,7 @@ extensions = (
 
 
 def bot_task_callback(future: asyncio.Future):
-    if future.exception():
+    if not future.cancelled() and future.exception():
         raise future.exception()
 
 
@@ -28,7 +39,31 @@ async def run_bot():
         intents=intents,
         command_prefix='!',
         slash_commands=True,
+        http_trace=discord_rate_limit_trace() if settings.METRICS_ENABLED else None,
+    )
+    backend = set_parser_backend(settings.HTML_PARSER_BACKEND)
+    configure_executor(
+        settings.EXECUTOR_KIND,
+        settings.EXECUTOR_WORKERS,
+        initializer=set_parser_backend,
+        initargs=(backend,)
     )
+    # One pooled HTTP client for the whole bot. Cogs receive it through bot.session.
+    bot.session = create_session(
+        limit=settings.HTTP_CONNECTION_LIMIT,
+        limit_per_host=settings.HTTP_CONNECTION_LIMIT_PER_HOST,
+        dns_ttl=settings.HTTP_DNS_CACHE_TTL,
+        keepalive_timeout=settings.HTTP_KEEPALIVE_TIMEOUT,
+        total_timeout=settings.HTTP_TOTAL_TIMEOUT,
+        connect_timeout=settings.HTTP_CONNECT_TIMEOUT,
+    )
+    bot.history = HistoryStore(str(settings.HISTORY_PATH))
+    # Cogs register their polling with the scheduler instead of running their own loops
+    bot.scheduler = PollScheduler(spacing=settings.POLL_SPACING)
+    bot.scheduler.start()
+    metrics_runner = None
+    if settings.METRICS_ENABLED:
+        metrics_runner = await start_metrics_server(settings.METRICS_HOST, settings.METRICS_PORT)
     try:
         for ext in extensions:
             await bot.load_extension(ext)
@@ -36,8 +71,17 @@ async def run_bot():
 
         await bot.start(token)
     finally:
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await bot.scheduler.stop()
         await bot.close()
+        await bot.session.close()
+        shutdown_executor()
+        close_store()
+        bot.history.close()
 
+# Last resort for exits that skip run_bot's cleanup. Does nothing once the store has been closed
+atexit.register(close_store)
 loop = asyncio.new_event_loop()
 try:
     future = asyncio.ensure_future(
@@ -47,6 +91,11 @@ try:
     future.add_done_callback(bot_task_callback)
     loop.run_forever()
 except KeyboardInterrupt:
-    pass
+    # Let run_bot's cleanup run, it flushes the settings saved in the last SETTINGS_FLUSH_DELAY seconds
+    future.cancel()
+    try:
+        loop.run_until_complete(future)
+    except (asyncio.CancelledError, KeyboardInterrupt):
+        pass
 finally:
     loop.close()
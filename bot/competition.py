@@ -1,16 +1,34 @@
 import asyncio
+import json
 import logging
-from copy import deepcopy
-from typing import Optional, Dict, NamedTuple, Union, Any
+import sqlite3
+import time
+from functools import partial
+from datetime import datetime, timezone
+from pathlib import Path
+from collections import deque
+from typing import Optional, Dict, NamedTuple, Union, Any, List, AsyncIterator, Deque, TYPE_CHECKING
 
 import aiohttp
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 from mixins.config import ConfigMixin
-from tft.schema import CompetitionEntry
-from tft.services import fetch_page_source, find_active_competition, parse_with_soup, \
-    get_competition_label, parse_competition, make_competition_embed
+from tft.concurrency import fan_out, SingleFlight
+from tft.deltas import Movement, Snapshot, SnapshotFile, compute_movements, take_snapshot
+from tft.executor import run_blocking
+from tft.history import HistoryStore
+from tft.scheduler import PollScheduler
+from tft.metrics import EDIT_SECONDS, EDITS_SKIPPED, RENDER_SECONDS, TRACKED_GUILDS, CACHE_HIT_RATIO, hit_ratio
+from tft.http import ConditionalFetcher, FetchError, call_with_policy
+from tft.index import TraderIndex
+from tft.schema import CompetitionEntry, EntryBatch
+from tft.services import find_active_competition, read_competition_labels, \
+    parse_competition, make_competition_embed, embed_fingerprint, render_competition_table, make_movers_embed, \
+    EmbedCache, patch_time_remaining, make_compstats_embed, last_day_of_month
+
+if TYPE_CHECKING:
+    from tft.stats import CompetitionStats
 
 log = logging.getLogger(__name__)
 
@@ -21,20 +39,61 @@ class MessageInfo(NamedTuple):
 
 
 class CompetitionCog(ConfigMixin, commands.Cog):
+    # Polling interval the scheduler starts from, and the bounds it adapts it within
     _update_minutes = 10
+    _min_update_minutes = 2
+    _max_update_minutes = 30
+    # Re-send an unchanged embed this often to refresh its timestamp. None disables it.
+    _heartbeat_minutes: Optional[int] = 60
+    # How many message edits may be in flight at once, and how long a single edit may take.
+    # discord.py still queues each request behind its rate limit bucket.
+    _edit_concurrency = 10
+    _edit_timeout = 30
 
-    def __init__(self, bot: commands.Bot):
+    def __init__(
+            self,
+            bot: commands.Bot,
+            session: aiohttp.ClientSession,
+            history: HistoryStore,
+            scheduler: PollScheduler,
+            snapshot_path: Path
+    ):
         super(CompetitionCog, self).__init__()
         self.bot = bot
+        self.session = session
+        self.history = history
+        self.scheduler = scheduler
+        self.snapshot_file = SnapshotFile(str(snapshot_path))
+        # Rank and return of every entry at the previous poll, for the movement arrows
+        self._previous_snapshot: Optional[Snapshot] = None
+        self._snapshot_board: Optional[str] = None
+        self.movements: List[Movement] = []
+        self.fetcher = ConditionalFetcher(session)
         self.competition_list_url = "https://competitions.thefundedtraderprogram.com/"
         self.competition_details_url = "https://competitions.thefundedtraderprogram.com/competition/{id}"
         self.embed: Optional[discord.Embed] = None
-        self._task: Optional[asyncio.Task] = None
+        self.render_cache = EmbedCache()
+        TRACKED_GUILDS.track(lambda: len(self.config_settings), board='competition')
+        CACHE_HIT_RATIO.track(
+            lambda: hit_ratio(self.render_cache.hits, self.render_cache.misses), cache='competition_render'
+        )
+        self._flight = SingleFlight('competition')
+        self._last_published = time.monotonic()
+        # message id -> fingerprint of the embed last sent to it
+        self._fingerprints: Dict[int, str] = {}
         self.guild_map: Dict[str, MessageInfo] = {}
 
-    def _task_callback(self, future: asyncio.Future):
-        if future.exception():
-            raise future.exception()
+        # Last parsed state, reused when the site reports that a page has not changed
+        self.competition_id: Optional[int] = None
+        self.prize_pool: Optional[str] = None
+        self.remaining_contestants: Optional[str] = None
+        self.entries: List[CompetitionEntry] = []
+
+        # Every contestant of the active competition, for !rank
+        self.index = TraderIndex()
+        self._index_competition_id: Optional[int] = None
+        # Return distribution of the full field, worked out once per poll for !compstats
+        self.stats: Optional['CompetitionStats'] = None
 
     async def _fetch_saved_message(self, guild_id: int, message_info: MessageInfo) -> Optional[discord.PartialMessage]:
         """Fetch the message or update our settings that the message is gone
@@ -63,33 +122,57 @@ class CompetitionCog(ConfigMixin, commands.Cog):
             old_message = await self._fetch_saved_message(guild_id, old_info)
             if old_message is not None:
                 await self._delete_message(old_message)
+            self._fingerprints.pop(old_info.message_id, None)
         self.config_settings[str(guild_id)] = message_info
+        self._fingerprints[message_info.message_id] = embed_fingerprint(self.embed)
         self.save_settings()
 
-    async def _update_guild_message(self, guild_id: int, message_info: MessageInfo, embed: discord.Embed):
-        """Updates the embed with the new polled information."""
+    async def _update_guild_message(
+            self,
+            guild_id: int,
+            message_info: MessageInfo,
+            embed: discord.Embed,
+            force: bool = False
+    ):
+        """Updates the embed with the new polled information.
+        The edit is skipped when the message already shows the same content unless force is set."""
+        fingerprint = embed_fingerprint(embed)
+        if not force and self._fingerprints.get(message_info.message_id) == fingerprint:
+            EDITS_SKIPPED.inc(board='competition')
+            return
         message = await self._fetch_saved_message(guild_id, message_info)
         if message is None:
             del self.config_settings[str(guild_id)]
+            self._fingerprints.pop(message_info.message_id, None)
             self.save_settings()
             return
         try:
-            await message.edit(embed=embed)
+            with EDIT_SECONDS.time(board='competition'):
+                await message.edit(embed=embed)
+            self._fingerprints[message_info.message_id] = fingerprint
         except discord.NotFound:
             del self.config_settings[str(guild_id)]
+            self._fingerprints.pop(message_info.message_id, None)
             self.save_settings()
 
+    @property
+    def rankings_url(self) -> str:
+        return "{}/leaderboard/getleaderboarddata".format(self.competition_list_url)
+
+    @staticmethod
+    def _convert_ranking(o: Dict[str, Any], rank: int) -> CompetitionEntry:
+        return CompetitionEntry(
+            rank=rank,
+            name=o['nickname'],
+            roi=o['returnPct'],
+            back=o['backPct'],
+            prize=o['prize']
+        )
+
     async def fetch_competition_rankings(self, competition_id: int, start: int = 0, length: int = 10):
-        def convert(o: Dict[str, Any], rank: int) -> CompetitionEntry:
-            return CompetitionEntry(
-                rank=rank,
-                name=o['nickname'],
-                roi=o['returnPct'],
-                back=o['backPct'],
-                prize=o['prize']
-            )
+        """Fetches one page of the rankings. A reply that cannot be read comes back as an empty list.
+        Raises FetchError when the rankings could not be fetched"""
         container = []
-        target = "{}/leaderboard/getleaderboarddata".format(self.competition_list_url)
         headers = {
             "accept": "application/json"
         }
@@ -98,36 +181,182 @@ class CompetitionCog(ConfigMixin, commands.Cog):
             "start": start,
             "length": length
         }
+        # A FetchError is left to propagate so the scheduler sees the outage
+        result = await self.fetcher.fetch(self.rankings_url, method='POST', data=data, headers=headers)
         try:
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.post(target, data=data) as resp:
-                    resp = await resp.json()
-                    for idx, o in enumerate(resp.get('data', [])):
-                        container.append(convert(o, idx+1))
-        except Exception as e:
-            log.error("Could not fetch competition listings")
+            resp = json.loads(result.text)
+            for idx, o in enumerate(resp.get('data', [])):
+                container.append(self._convert_ranking(o, start + idx + 1))
+        except (ValueError, KeyError, AttributeError) as e:
+            log.error("Could not read competition listings")
             log.error(e)
         return container
 
+    async def _fetch_rankings_page(self, competition_id: int, start: int, length: int) -> List[CompetitionEntry]:
+        """Fetches one page of the rankings without keeping it around for conditional requests.
+        Raises FetchError when the page could not be fetched"""
+        data = {
+            "competitionId": competition_id,
+            "start": start,
+            "length": length
+        }
 
+        async def request():
+            async with self.session.post(self.rankings_url, data=data, headers={"accept": "application/json"}) as resp:
+                resp.raise_for_status()
+                return await resp.json(content_type=None)
 
-    async def update(self):
-        """Fetches HTML from TFT and parses it, and generates an embed."""
+        resp = await self._flight.do(('rankings', competition_id, start, length),
+                                     partial(call_with_policy, self.rankings_url, request))
+        return [self._convert_ranking(o, start + idx + 1) for idx, o in enumerate(resp.get('data', []))]
+
+    async def iter_competition_rankings(
+            self,
+            competition_id: int,
+            page_size: int = 100,
+            max_in_flight: int = 4
+    ) -> AsyncIterator[List[CompetitionEntry]]:
+        """Pages through the whole competition field, yielding one batch of entries per page in rank order.
+        Up to max_in_flight pages are requested ahead of the consumer. Paging stops at the first short page."""
+        pending: Deque[asyncio.Task] = deque()
+        next_start = 0
+
+        def request_next_page():
+            nonlocal next_start
+            pending.append(asyncio.ensure_future(self._fetch_rankings_page(competition_id, next_start, page_size)))
+            next_start += page_size
+
+        try:
+            for _ in range(max_in_flight):
+                request_next_page()
+            while pending:
+                page = await pending.popleft()
+                if page:
+                    yield page
+                if len(page) < page_size:
+                    break
+                request_next_page()
+        finally:
+            # Pages requested past the end of the field are not needed
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def update(self) -> bool:
+        """Refreshes the data. Callers arriving while a refresh is running wait for it and share its result"""
+        return await self._flight.do('update', self._update)
+
+    async def _update(self) -> bool:
+        """Fetches HTML from TFT and parses it, and generates an embed.
+        Pages that the site reports as unchanged are not parsed again. Returns False when
+        nothing changed since the last poll and the last good embed was kept as is.
+        Raises FetchError when the site could not be reached."""
         log.info("Updating Embed from TFT site.")
-        competition_list_html = await fetch_page_source(self.competition_list_url, log)
-        competition_id = find_active_competition(competition_list_html)
+        try:
+            competition_list = await self.fetcher.fetch(self.competition_list_url)
+            if competition_list.changed or self.competition_id is None:
+                self.competition_id = await run_blocking(find_active_competition, competition_list.text)
+            competition_id = self.competition_id
+            if competition_id is None:
+                return False
+
+            # The details page is very large and only two labels are needed from it, so it is streamed
+            # and the download stops as soon as both have been seen. A 304 skips the download entirely.
+            details = await self.fetcher.stream(
+                self.competition_details_url.format(id=competition_id),
+                partial(read_competition_labels, labels=("prize pool", "remaining contestants"))
+            )
+            entries = await self.fetch_competition_rankings(competition_id)
+        except FetchError as e:
+            log.error(f"Could not fetch the competition. Keeping the last good data. {e}")
+            raise
+        prize_pool = details.value["prize pool"] or "Not Found"
+        remaining_contestants = details.value["remaining contestants"] or "Not Found"
+        details_changed = details.changed or \
+            (prize_pool, remaining_contestants) != (self.prize_pool, self.remaining_contestants)
+        if not entries:
+            log.error("No competition rankings found. Keeping the last good data.")
+            return False
+        if not details_changed and entries == self.entries and self.embed is not None:
+            log.info("Competition unchanged since last poll.")
+            return False
+        self.prize_pool = prize_pool
+        self.remaining_contestants = remaining_contestants
+        self.entries = entries
+        await self._track_movements(f'competition-{self.competition_id}')
+        self.embed = await self._render_embed()
+        await self._record_history(f'competition-{self.competition_id}')
+        return True
+
+    async def _refresh_index(self):
+        """Pages through the full field and applies it to the nickname index.
+        The last complete index is kept when a page could not be fetched"""
+        competition_id = self.competition_id
         if competition_id is None:
             return
+        if competition_id != self._index_competition_id:
+            self.index.clear()
+            self.stats = None
+            self._index_competition_id = competition_id
+        started = time.perf_counter()
+        entries: List[CompetitionEntry] = []
+        try:
+            async for page in self.iter_competition_rankings(competition_id):
+                entries.extend(page)
+        except (FetchError, ValueError, KeyError, AttributeError) as e:
+            # ValueError covers a body that is not JSON, KeyError and AttributeError a reply in an unexpected shape
+            log.error(f"Could not page through the competition field. Keeping the last index. {e!r}")
+            return
+        if not entries:
+            return
+        batch = EntryBatch(entries)
+        change = self.index.update(batch)
+        # Imported here so numpy is only needed once the full field has been loaded
+        from tft.stats import compute_competition_stats
+        self.stats = await run_blocking(compute_competition_stats, batch)
+        log.info(
+            f"Indexed {len(self.index)} contestants in {time.perf_counter() - started:.2f}s "
+            f"({change.added} added, {change.updated} updated, {change.removed} removed)"
+        )
+
+    async def _track_movements(self, board: str):
+        """Works out how every entry moved since the previous poll and persists the new snapshot"""
+        if self._previous_snapshot is None or self._snapshot_board != board:
+            self._previous_snapshot = await asyncio.to_thread(self.snapshot_file.load, board)
+            self._snapshot_board = board
+        self.movements = compute_movements(self._previous_snapshot, self.entries)
+        self._previous_snapshot = take_snapshot(self.entries)
+        try:
+            await asyncio.to_thread(self.snapshot_file.save, board, self._previous_snapshot)
+        except IOError as e:
+            log.error(f"Could not save the {board} snapshot: {e}")
 
-        competition_html = await fetch_page_source(self.competition_details_url.format(id=competition_id), log)
-        # We cache the soup object in here since the result is so large.
-        soup = parse_with_soup(competition_html)
-        prize_pool = get_competition_label(soup, "prize pool") or "Not Found"
-        remaining_contestants = get_competition_label(soup, "remaining contestants") or "Not Found"
-        entries = await self.fetch_competition_rankings(competition_id)
-        embed = make_competition_embed(entries, prize_pool, remaining_contestants)
-        embed.set_footer(text=f"Updated every {self._update_minutes} minutes")
-        self.embed = embed
+    async def _record_history(self, board: str):
+        try:
+            await asyncio.to_thread(self.history.record, board, self.entries)
+        except sqlite3.Error as e:
+            log.error(f"Could not record {board} history: {e}")
+
+    async def _render_embed(self) -> discord.Embed:
+        # The title carries the month name, so a new month is a new key
+        key = EmbedCache.key(
+            'competition',
+            self.entries,
+            self.movements,
+            self.prize_pool,
+            self.remaining_contestants,
+            self._update_minutes,
+            datetime.now(timezone.utc).month
+        )
+        embed = self.render_cache.get(key)
+        if embed is not None:
+            return patch_time_remaining(embed)
+        with RENDER_SECONDS.time(board='competition'):
+            table = await run_blocking(render_competition_table, self.entries, self.movements)
+            embed = make_competition_embed(self.entries, self.prize_pool, self.remaining_contestants, table=table)
+            embed.set_footer(text=f"Updated every {self._update_minutes} minutes")
+        self.render_cache.put(key, embed)
+        return embed
 
     def get_saved_message_info(self, guild_id: int) -> Optional[MessageInfo]:
         """Helper function that converts our dictionary back to a Named Tuple.
@@ -140,26 +369,66 @@ class CompetitionCog(ConfigMixin, commands.Cog):
             return MessageInfo(channel_id=o[0], message_id=o[1])
         return o
 
-    @tasks.loop(minutes=_update_minutes, reconnect=True)
-    async def update_task(self):
-        """The actual polling task. To change the time, change _update_minutes at the top of this file"""
+    async def poll(self) -> bool:
+        """Called by the bot's poll scheduler. Returns whether the data changed so it can adapt the interval.
+        Raises FetchError when the site could not be reached, which the scheduler counts as a failure and backs off from.
+        To change the base interval, change _update_minutes at the top of this file"""
         await self.bot.wait_until_ready()
-        await self.update()
-        for guild_id in deepcopy(list(self.config_settings.keys())):
-            guild_id = int(guild_id)
+        heartbeat = bool(self._heartbeat_minutes) and \
+            time.monotonic() - self._last_published >= self._heartbeat_minutes * 60
+        try:
+            changed = await self.update()
+        except FetchError:
+            # The rankings come from their own endpoint and may still be reachable
+            await self._refresh_index()
+            raise
+        await self._refresh_index()
+        if not changed:
+            if not heartbeat or not self.entries:
+                return False
+            self.embed = await self._render_embed()
+        embed = self.embed
+        self._last_published = time.monotonic()
+
+        async def publish(guild_id: int):
             message_info = self.get_saved_message_info(guild_id)
-            await self._update_guild_message(guild_id, message_info, self.embed)
+            await self._update_guild_message(guild_id, message_info, embed, force=heartbeat)
+
+        guild_ids = [int(guild_id) for guild_id in self.config_settings.keys()]
+        started = time.perf_counter()
+        results = await fan_out(publish, guild_ids, limit=self._edit_concurrency, timeout=self._edit_timeout)
+        failed = 0
+        for guild_id, result in zip(guild_ids, results):
+            if isinstance(result, asyncio.TimeoutError):
+                failed += 1
+                log.warning(f"Timed out updating message in guild {guild_id}")
+            elif isinstance(result, Exception):
+                failed += 1
+                log.error(f"Failed to update message in guild {guild_id}: {result}")
+        log.info(f"Updated {len(guild_ids)} guild messages in {time.perf_counter() - started:.2f}s ({failed} failed)")
+        return changed
+
+    @staticmethod
+    def _final_day() -> bool:
+        """Standings move the most on the last day of the monthly competition, so it is polled at the fastest rate"""
+        now = datetime.now(timezone.utc)
+        return last_day_of_month(now).date() == now.date()
 
     async def cog_load(self) -> None:
-        """Waits until the cache is loaded with guilds and then launches our task process"""
-        await self.bot.wait_until_ready()
-        log.info("Starting TFT Polling Task")
-        self._task = self.update_task.start()
-        self._task.add_done_callback(self._task_callback)
+        """Registers our polling with the bot's scheduler"""
+        log.info("Registering TFT competition polling")
+        self.scheduler.register(
+            'competition',
+            self.poll,
+            interval=self._update_minutes * 60,
+            min_interval=self._min_update_minutes * 60,
+            max_interval=self._max_update_minutes * 60,
+            url=self.competition_list_url,
+            urgent=self._final_day
+        )
 
     async def cog_unload(self) -> None:
-        if not self._task.done():
-            self._task.cancel()
+        self.scheduler.unregister('competition')
 
     @commands.has_role("Admin")
     @commands.command(name='competition')
@@ -167,7 +436,10 @@ class CompetitionCog(ConfigMixin, commands.Cog):
         """Fetches the Top 10 Leaderboard information from The Funded Trader"""
         await ctx.trigger_typing()
         if self.embed is None:
-            await self.update()
+            try:
+                await self.update()
+            except FetchError:
+                pass
 
         if self.embed is None:
             await ctx.send("No Competitions found.")
@@ -176,6 +448,44 @@ class CompetitionCog(ConfigMixin, commands.Cog):
         message_info = MessageInfo(channel_id=ctx.channel.id, message_id=message.id)
         await self._new_message(ctx.guild.id, message_info)
 
+    @commands.has_role("Admin")
+    @commands.command(name='competitionmovers')
+    async def competitionmovers_cmd(self, ctx: commands.Context):
+        """Lists the traders whose rank or return changed since the previous update"""
+        if not self.movements:
+            await ctx.send("No movements recorded yet.")
+            return
+        await ctx.send(embed=make_movers_embed("Competition Movers", self.movements))
+
+    @commands.command(name='compstats')
+    async def compstats_cmd(self, ctx: commands.Context):
+        """Shows how returns are spread across the whole competition field"""
+        if self.stats is None:
+            if len(self.index):
+                # compute_competition_stats found no contestant with a return
+                await ctx.send("No contestant in the competition has a return yet.")
+            else:
+                await ctx.send("The competition rankings have not been loaded yet.")
+            return
+        await ctx.send(embed=make_compstats_embed(self.stats))
+
+    @commands.command(name='rank')
+    async def rank_cmd(self, ctx: commands.Context, *, nickname: str):
+        """Looks up a contestant of the active competition by nickname, prefix or a close spelling"""
+        if not len(self.index):
+            await ctx.send("The competition rankings have not been loaded yet.")
+            return
+        matches = self.index.lookup(nickname)
+        if not matches:
+            await ctx.send(f"No contestant matching {nickname} found.", allowed_mentions=discord.AllowedMentions.none())
+            return
+        lines = [
+            f"#{entry.rank} {entry.name} | Return {entry.roi} | Back {entry.back} | Prize {entry.prize}"
+            for entry in matches
+        ]
+        # Nicknames are chosen by the contestants, so they must not be able to ping anyone
+        await ctx.send("```\n{}\n```".format("\n".join(lines)), allowed_mentions=discord.AllowedMentions.none())
+
     @competition_cmd.error
     async def leaderboard_error(self, ctx, error):
         name = ctx.author.display_name
@@ -187,4 +497,9 @@ class CompetitionCog(ConfigMixin, commands.Cog):
             log.error(error)
 
 async def setup(bot: commands.Bot):
-    await bot.add_cog(CompetitionCog(bot))
+    default = Path(__file__).parents[1] / 'static'
+    try:
+        from bot.settings import SNAPSHOT_DIR
+    except ImportError:
+        SNAPSHOT_DIR = default
+    await bot.add_cog(CompetitionCog(bot, bot.session, bot.history, bot.scheduler, SNAPSHOT_DIR / 'last_competition.json'))
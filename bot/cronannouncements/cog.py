@@ -4,67 +4,150 @@ import logging
 from functools import partial
 from json import JSONDecodeError
 from pathlib import Path
-from typing import Dict, List, Set
+from collections import Counter
+from typing import Dict, List, NamedTuple, Tuple, Iterable, Optional
 
-import aiocron
 import aiohttp
+from atomicwrites import atomic_write
 from croniter import CroniterBadCronError
 from discord.ext import commands
 
+from bot.cronannouncements.scheduler import CronScheduler, CronJob
 from bot.cronannouncements.schema import Announcement
 from mixins.config import ConfigMixin
+from tft.http import ConditionalFetcher, FetchError
 
 log = logging.getLogger(__name__)
 
+# (guild id, channel id, crontab, n): n tells apart announcements that share a channel and schedule,
+# in the order they appear in the document
+JobKey = Tuple[int, int, str, int]
+
+
+def index_announcements(announcements: Iterable[Announcement]) -> Dict[int, Dict[JobKey, Announcement]]:
+    """Groups announcements by guild id and gives each a key that stays the same across reloads
+    as long as its channel and schedule do"""
+    index: Dict[int, Dict[JobKey, Announcement]] = {}
+    seen = Counter()
+    for a in announcements:
+        base = (a.guild_id, a.channel_id, a.crontab_fmt)
+        index.setdefault(a.guild_id, {})[base + (seen[base],)] = a
+        seen[base] += 1
+    return index
+
+
+class ReloadReport(NamedTuple):
+    started: int = 0
+    stopped: int = 0
+    updated: int = 0
+    unchanged: int = 0
+
+    def __str__(self):
+        return f"{self.started} started, {self.stopped} stopped, {self.updated} updated, {self.unchanged} unchanged"
+
 
 class CronAnnouncementCog(ConfigMixin, commands.Cog):
     
-    def __init__(self, bot: commands.Bot, path: Path, filename='announcements.json'):
+    def __init__(self, bot: commands.Bot, session: aiohttp.ClientSession, path: Path, filename='announcements.json'):
         super(CronAnnouncementCog, self).__init__()
         self.bot = bot
-        self.jobs: Dict[int, Set[aiocron.Cron]] = {}
+        self.session = session
+        # Every announcement runs on one shared timer
+        self.scheduler = CronScheduler(self.make_announcement)
+        # guild id -> key -> running job
+        self.jobs: Dict[int, Dict[JobKey, CronJob]] = {}
         self.path = path
         self.filename = filename
-        self.announcements: List[Announcement] = []
+        # guild id -> key -> announcement, as last loaded
+        self.announcements: Dict[int, Dict[JobKey, Announcement]] = {}
         self.npoint_path = "https://api.npoint.io/9d12a7d9eaaad7543dbb"
-
-    def job_task_callback(announcement: Announcement, future: asyncio.Future):
-
-        if future.exception():
-            raise future.exception()
+        # Remembers the validators of the last npoint reply so a reload of an unchanged document is a 304
+        self.fetcher = ConditionalFetcher(session)
+        self._refresh_task: Optional[asyncio.Task] = None
 
     async def _npoint_load(self):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.npoint_path, raise_for_status=True) as resp:
-                try:
-                    data = await resp.json()
-                    return data
-                except JSONDecodeError as e:
-                    log.error(f"{self.npoint_path} is improperly formatted JSON {e}")
-                    raise
+        result = await self.fetcher.fetch(self.npoint_path)
+        if not result.changed:
+            log.info(f"{self.npoint_path} has not changed since the last load")
+        try:
+            return json.loads(result.text)
+        except JSONDecodeError as e:
+            log.error(f"{self.npoint_path} is improperly formatted JSON {e}")
+            raise
 
     async def cog_load(self) -> None:
+        """Starts the jobs from the last good document on disk right away and checks npoint in the background"""
+        self.scheduler.start()
         try:
-            await self.start_all_jobs()
+            announcements = await asyncio.to_thread(self._load_announcements_from_file)
         except FileNotFoundError:
-            log.warning(f"No Announcement Jobs started. Missing announcements file {self.path / self.filename}")
+            log.warning(f"No cached announcements in {self.path / self.filename}, waiting for npoint")
+        except (JSONDecodeError, TypeError, ValueError) as e:
+            log.error(f"Ignoring the cached announcements in {self.path / self.filename}: {e}")
+        else:
+            self.announcements = index_announcements(announcements)
+            self.apply()
+        self._refresh_task = asyncio.ensure_future(self._background_refresh())
 
     async def cog_unload(self) -> None:
-        for guild_id in self.jobs.keys():
-            self.stop_jobs(guild_id)
+        if self._refresh_task is not None and not self._refresh_task.done():
+            self._refresh_task.cancel()
+        self.stop_all_jobs()
+        await self.scheduler.stop()
+
+    async def _background_refresh(self):
+        try:
+            await self.refresh()
+        except Exception as e:
+            log.error(f"Could not refresh announcements from npoint, keeping the cached schedule. {e!r}")
 
-    async def start_all_jobs(self):
-        if not self.announcements:
-            self.announcements = await self._load_announcements_from_npoint()
-        self.start_jobs(*self.announcements)
+    async def refresh(self, guild_ids: Optional[Iterable[int]] = None) -> ReloadReport:
+        """Loads the npoint document, keeps it on disk as the last good copy and reconciles the jobs of guild_ids
+        (every guild when None) with it"""
+        data = await self._npoint_load()
+        announcements = [Announcement(**v) for v in data]
+        try:
+            await asyncio.to_thread(self._save_announcements_to_file, data)
+        except IOError as e:
+            log.error(f"Could not cache the announcements in {self.path / self.filename}: {e}")
+        self.announcements = index_announcements(announcements)
+        return self.apply(guild_ids)
 
     def stop_all_jobs(self):
         for guild_id, seq in self.jobs.items():
-            for task in seq:
-                log.info(f"Stopping Guild {guild_id} Job {task.uuid}")
-                task.stop()
+            for job in seq.values():
+                log.info(f"Stopping Guild {guild_id} Job {job.id}")
+        self.scheduler.clear()
         self.jobs = {}
 
+    def apply(self, guild_ids: Optional[Iterable[int]] = None) -> ReloadReport:
+        """Brings the running jobs of guild_ids (every guild when None) in line with self.announcements.
+        Jobs whose key disappeared are stopped, new keys are started and jobs whose content changed get the new
+        announcement without being rescheduled. Everything else is left running."""
+        if guild_ids is None:
+            guild_ids = set(self.announcements) | set(self.jobs)
+        started = stopped = updated = unchanged = 0
+        for guild_id in guild_ids:
+            wanted = self.announcements.get(guild_id, {})
+            running = self.jobs.setdefault(guild_id, {})
+            for key in [key for key in running if key not in wanted]:
+                self.scheduler.remove(running.pop(key))
+                stopped += 1
+            for key, announcement in wanted.items():
+                job = running.get(key)
+                if job is None:
+                    started += self._start_job(key, announcement)
+                elif job.announcement != announcement:
+                    job.announcement = announcement
+                    updated += 1
+                else:
+                    unchanged += 1
+            if not running:
+                del self.jobs[guild_id]
+        report = ReloadReport(started=started, stopped=stopped, updated=updated, unchanged=unchanged)
+        log.info(f"Announcement jobs reconciled: {report}")
+        return report
+
     @commands.group(name='announcements')
     async def announcements(self, ctx):
         pass
@@ -72,30 +155,32 @@ class CronAnnouncementCog(ConfigMixin, commands.Cog):
     @commands.has_role("Admin")
     @announcements.command()
     async def reloadall(self, ctx: commands.Context):
-        self.announcements = await self._load_announcements_from_npoint()
-        self.stop_all_jobs()
-        await self.start_all_jobs()
-        await ctx.send("All guild jobs reloaded and restarted")
+        report = await self.refresh()
+        await ctx.send(f"All guild jobs reloaded: {report}")
 
     @commands.has_role("Admin")
     @announcements.command()
     async def reload(self, ctx: commands.Context):
-        self.announcements = await self._load_announcements_from_npoint()
-        jobs = [j for j in self.announcements if j.guild_id == ctx.guild.id]
-        guild_id = ctx.guild.id
-        self.stop_jobs(guild_id)
-        self.start_jobs(*jobs)
-        await ctx.send("This guild jobs reloaded and restarted")
+        report = await self.refresh([ctx.guild.id])
+        await ctx.send(f"This guild jobs reloaded: {report}")
 
     @reload.error
     @reloadall.error
     async def reload_error(self, ctx, error):
+        if isinstance(error, commands.MissingRole):
+            log.warning(f"{ctx.author.display_name} tried to reload announcements in guild: {ctx.guild.name} "
+                        f"without the Admin role")
+            return
+        if not isinstance(error, commands.CommandInvokeError):
+            raise error
         exception: Exception = error.original
         if isinstance(exception, JSONDecodeError):
             await ctx.send("JSON file is not properly formatted")
-        if isinstance(exception, FileNotFoundError):
+        elif isinstance(exception, FileNotFoundError):
             await ctx.send("No Announcement file to reload jobs from")
-        if isinstance(exception, CroniterBadCronError):
+        elif isinstance(exception, FetchError):
+            await ctx.send("Could not reach the announcements document, the current jobs keep running")
+        elif isinstance(exception, CroniterBadCronError):
             await ctx.send(f"The CRON Format in the JSON format is not properly formed {exception}")
         else:
             raise error
@@ -110,51 +195,34 @@ class CronAnnouncementCog(ConfigMixin, commands.Cog):
                 log.error(f"{filename} is improperly formatted JSON {e}")
                 raise
 
-    async def _load_announcements_from_npoint(self) -> List[Announcement]:
-        data = await self._npoint_load()
-        return [Announcement(**v) for v in data]
-
-    def _add_job(self, guild_id: int, job: aiocron.Cron):
-        if guild_id not in self.jobs.keys():
-            self.jobs[guild_id] = set()
-        self.jobs[guild_id].add(job)
-
-    def _remove_job(self, guild_id: int, job: aiocron.Cron):
-        if job in self.jobs.get(guild_id, set()):
-            self.jobs[guild_id].remove(job)
+    def _save_announcements_to_file(self, data: List[dict]):
+        filename = self.path / self.filename
+        filename.parent.mkdir(parents=True, exist_ok=True)
+        with atomic_write(str(filename), overwrite=True, encoding='utf-8') as f:
+            json.dump(data, f, indent=2)
 
     def stop_jobs(self, guild_id: int):
-        jobs = self.jobs.get(guild_id, set())
-        for job in jobs:
-            job.stop()
+        jobs = self.jobs.pop(guild_id, {})
+        for job in jobs.values():
+            self.scheduler.remove(job)
         log.info(f"Stopped All Jobs for Guild {guild_id}")
 
-    def _start_job(self, announcement: Announcement):
+    def _start_job(self, key: JobKey, announcement: Announcement) -> bool:
         try:
-            job = aiocron.Cron(announcement.crontab_fmt, self.make_announcement, args=(announcement,), start=True)
-            self._add_job(announcement.guild_id, job)
+            job = self.scheduler.add(announcement)
         except CroniterBadCronError:
             log.error(f"Invalid format for CRON Job {announcement}")
-        else:
-            log.info("Starting CRON Job {} for Guild {} / Channel {}".format(
-                announcement.crontab_fmt,
-                announcement.guild_id,
-                announcement.channel_id
-            ))
-
-    def start_jobs(self, *announcements: Announcement):
-        for a in announcements:
-            self._start_job(a)
+            return False
+        self.jobs.setdefault(announcement.guild_id, {})[key] = job
+        log.info("Starting CRON Job {} for Guild {} / Channel {}".format(
+            announcement.crontab_fmt,
+            announcement.guild_id,
+            announcement.channel_id
+        ))
+        return True
 
     def get_guild_announcements(self, guild_id: int) -> List[Announcement]:
-        announcements = [a for a in self.announcements if a.guild_id == guild_id]
-        return announcements
-
-    def restart_jobs(self, guild_id: int):
-        log.info(f"Restarting all Jobs for Guild {guild_id}")
-        announcements = self.get_guild_announcements(guild_id)
-        self.stop_jobs(guild_id)
-        self.start_jobs(*announcements)
+        return list(self.announcements.get(guild_id, {}).values())
 
     async def make_announcement(self, announcement: Announcement):
         guild_id = announcement.guild_id
@@ -171,12 +239,12 @@ class CronAnnouncementCog(ConfigMixin, commands.Cog):
 
         
 async def setup(bot: commands.Bot):
-    default = Path(__file__).parents[1] / '/static/'
+    default = Path(__file__).parents[2] / 'static'
     try:
         from bot.settings import ANNOUNCEMENT_DIR
     except ImportError:
         ANNOUNCEMENT_DIR = default
 
-    await bot.add_cog(CronAnnouncementCog(bot, ANNOUNCEMENT_DIR))
+    await bot.add_cog(CronAnnouncementCog(bot, bot.session, ANNOUNCEMENT_DIR))
     
     
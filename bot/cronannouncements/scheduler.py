@@ -0,0 +1,131 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from datetime import datetime
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from croniter import croniter
+
+from bot.cronannouncements.schema import Announcement
+
+log = logging.getLogger(__name__)
+
+
+class CronJob:
+    """A scheduled announcement. Jobs compare by identity, so they can be kept in sets"""
+    __slots__ = ('id', 'announcement', 'next_fire', 'cancelled', '_iter')
+
+    def __init__(self, job_id: int, announcement: Announcement, start: datetime):
+        self.id = job_id
+        self.announcement = announcement
+        # Raises CroniterBadCronError for a malformed expression
+        self._iter = croniter(announcement.crontab_fmt, start)
+        self.next_fire: float = self._iter.get_next(float)
+        self.cancelled = False
+
+    def advance(self, now: float) -> float:
+        """Moves to the first fire time after now. Fire times missed while the bot was busy are skipped"""
+        while self.next_fire <= now:
+            self.next_fire = self._iter.get_next(float)
+        return self.next_fire
+
+
+class CronScheduler:
+    """Runs every cron announcement from one task and one min-heap ordered by next fire time.
+
+    The task sleeps until the earliest fire time, sends every announcement due at that moment as one batch and
+    pushes each job back with its following fire time. add() is a heap push. remove() only marks the job, and
+    cancelled entries are dropped when they reach the top of the heap or when they make up half of it.
+    Cron expressions are read in the bot's local time zone, the same as aiocron did.
+    """
+    def __init__(self, callback: Callable[[Announcement], Awaitable[None]]):
+        self.callback = callback
+        self.fired = 0
+        self._heap: List[Tuple[float, int, CronJob]] = []
+        self._jobs: Dict[int, CronJob] = {}
+        self._ids = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._sending: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def add(self, announcement: Announcement) -> CronJob:
+        job = CronJob(next(self._ids), announcement, datetime.now().astimezone())
+        self._jobs[job.id] = job
+        heapq.heappush(self._heap, (job.next_fire, job.id, job))
+        if self._heap[0][2] is job:
+            # The new job is due before whatever the task is sleeping on
+            self._wakeup.set()
+        return job
+
+    def remove(self, job: CronJob):
+        if self._jobs.pop(job.id, None) is None:
+            return
+        job.cancelled = True
+        if len(self._heap) > 2 * len(self._jobs) + 16:
+            self._heap = [item for item in self._heap if not item[2].cancelled]
+            heapq.heapify(self._heap)
+
+    def clear(self):
+        for job in self._jobs.values():
+            job.cancelled = True
+        self._jobs.clear()
+        self._heap.clear()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        tasks = list(self._sending)
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            while self._heap and self._heap[0][2].cancelled:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                await self._wakeup.wait()
+                continue
+            delay = self._heap[0][0] - time.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            self._fire_due(time.time())
+
+    def _fire_due(self, now: float):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            _, _, job = heapq.heappop(self._heap)
+            if job.cancelled:
+                continue
+            due.append(job.announcement)
+            heapq.heappush(self._heap, (job.advance(now), job.id, job))
+        if not due:
+            return
+        self.fired += len(due)
+        log.debug(f"Firing {len(due)} announcements")
+        # Sending runs beside the timer so a slow channel cannot hold up the next batch
+        task = asyncio.ensure_future(self._send(due))
+        self._sending.add(task)
+        task.add_done_callback(self._sending.discard)
+
+    async def _send(self, due: List[Announcement]):
+        results = await asyncio.gather(*(self.callback(a) for a in due), return_exceptions=True)
+        for announcement, result in zip(due, results):
+            if isinstance(result, Exception):
+                log.error(f"Announcement for Guild {announcement.guild_id} / Channel {announcement.channel_id} "
+                          f"failed: {result!r}")
@@ -0,0 +1,106 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, List, Optional, Type, TypeVar, Any
+
+import aiohttp
+from atomicwrites import atomic_write
+from pydantic import BaseModel
+
+from tft.concurrency import SingleFlight
+from tft.executor import run_blocking
+from tft.http import call_with_policy
+
+log = logging.getLogger(__name__)
+
+M = TypeVar('M', bound=BaseModel)
+
+
+class FaqPageCache:
+    """Parsed help center pages, kept in memory and in a JSON file so they survive a restart.
+
+    Within ``ttl`` seconds of the last check a page is served without touching the site. After that it is
+    revalidated with If-None-Match / If-Modified-Since, and only re-parsed when the site sends a body that
+    differs from the one the cached items were parsed from.
+    """
+    def __init__(self, session: aiohttp.ClientSession, path: str, ttl: float = 60 * 60):
+        self.session = session
+        self.path = path
+        self.ttl = ttl
+        self.hits = 0
+        self.fetched = 0
+        self.parsed = 0
+        # url -> {etag, last_modified, digest, checked_at, items}
+        self._pages: Optional[Dict[str, Dict[str, Any]]] = None
+        self._dirty = False
+        self._flight = SingleFlight('faq')
+
+    def _load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def _dump(self, text: str):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with atomic_write(self.path, overwrite=True, encoding='utf-8') as f:
+            f.write(text)
+
+    async def get(self, url: str, parse: Callable[[str], List[M]], model: Type[M]) -> List[M]:
+        """Returns the items parsed from url, from the cache when it is fresh or the site says it has not changed"""
+        if self._pages is None:
+            self._pages = await asyncio.to_thread(self._load)
+        return await self._flight.do(url, lambda: self._get(url, parse, model))
+
+    async def _get(self, url: str, parse: Callable[[str], List[M]], model: Type[M]) -> List[M]:
+        cached = self._pages.get(url)
+        if cached is not None and time.time() - cached['checked_at'] < self.ttl:
+            self.hits += 1
+            return [model.parse_obj(item) for item in cached['items']]
+
+        headers = {}
+        if cached is not None:
+            if cached.get('etag'):
+                headers['If-None-Match'] = cached['etag']
+            if cached.get('last_modified'):
+                headers['If-Modified-Since'] = cached['last_modified']
+
+        async def request():
+            async with self.session.get(url, headers=headers) as resp:
+                if resp.status == 304 and cached is not None:
+                    return None
+                resp.raise_for_status()
+                body = await resp.read()
+                return body, resp.headers.get('ETag'), resp.headers.get('Last-Modified')
+
+        reply = await call_with_policy(url, request)
+        self._dirty = True
+        if reply is not None:
+            body, etag, last_modified = reply
+            digest = hashlib.sha256(body).hexdigest()
+            if cached is None or cached['digest'] != digest:
+                items = await run_blocking(parse, body.decode('utf-8', errors='replace'))
+                self.parsed += 1
+                cached = {'digest': digest, 'items': [item.dict() for item in items]}
+                self._pages[url] = cached
+            cached['etag'] = etag
+            cached['last_modified'] = last_modified
+        self.fetched += 1
+        cached['checked_at'] = time.time()
+        return [model.parse_obj(item) for item in cached['items']]
+
+    async def save(self):
+        """Writes the cache to disk if anything was fetched since the last save"""
+        if not self._dirty or self._pages is None:
+            return
+        self._dirty = False
+        # Serialised here so the pages cannot change underneath the writer thread
+        text = json.dumps(self._pages)
+        try:
+            await asyncio.to_thread(self._dump, text)
+        except IOError as e:
+            log.error(f"Could not save the FAQ cache to {self.path}: {e}")
@@ -1,9 +1,18 @@
-from typing import List, Dict
+import time
+from pathlib import Path
+from datetime import timedelta
+from typing import List, Dict, Optional
 
+import aiohttp
 from discord.ext import commands
 
-from bot.faq.services import get_faq_categories, get_html, get_articles
+from bot.faq.cache import FaqPageCache
+from bot.faq.schema import FaqCategory, FaqArticle
+from bot.faq.services import parse_faq_categories, parse_articles
 from mixins.config import ConfigMixin
+from tft.concurrency import fan_out
+from tft.metrics import CACHE_HIT_RATIO, hit_ratio
+from tft.services import embed_fingerprint
 import discord
 import logging
 
@@ -11,67 +20,163 @@ import logging
 log = logging.getLogger(__name__
                         )
 class Faq(ConfigMixin, commands.Cog):
+    # How many category pages are fetched at once, and how long a single one may take
+    _crawl_concurrency = 5
+    _crawl_timeout = 60
 
-    def __init__(self, bot: commands.Bot):
+    def __init__(self, bot: commands.Bot, session: aiohttp.ClientSession, cache_path: Path, cache_ttl: float):
         super(Faq, self).__init__()
         self.bot = bot
+        self.session = session
         self.base_url = "https://help.thefundedtraderprogram.com/"
         self.faq_category_url = "https://help.thefundedtraderprogram.com/en"
+        self.cache = FaqPageCache(session, str(cache_path), ttl=cache_ttl)
+        CACHE_HIT_RATIO.track(lambda: hit_ratio(self.cache.hits, self.cache.fetched), cache='faq')
 
-    async def get_categories(self):
-        html = await get_html(self.faq_category_url)
-        return await get_faq_categories(html)
+    async def get_categories(self) -> List[FaqCategory]:
+        return await self.cache.get(self.faq_category_url, parse_faq_categories, FaqCategory)
 
-    async def get_articles(self, url: str):
+    async def get_articles(self, url: str) -> List[FaqArticle]:
         url = self.base_url + url
-        html = await get_html(url)
-        return await get_articles(html)
+        return await self.cache.get(url, parse_articles, FaqArticle)
 
-    def _save_message(self, message: discord.Message):
-        channel_id = message.channel.id
-        message_id = message.id
-        if self.config_settings.get('faq_messages') is None:
-            self.config_settings['faq_messages'] = {}
-
-        if channel_id not in self.config_settings['faq_messages'].keys():
-            self.config_settings['faq_messages'][channel_id] = []
-        self.config_settings['faq_messages'][channel_id].append(message_id)
-
-
-    async def _delete_old_messages(self):
-        for channel_id, message_ids in self.config_settings.get('faq_messages', {}).items():
-            channel = self.bot.get_channel(channel_id)
-            if channel is None:
-                log.warning(f"Tried to delete old messages but could not find channel id {channel_id}")
+    async def crawl(self) -> Dict[str, Optional[List[FaqArticle]]]:
+        """Fetches the articles of every category concurrently. Categories that fail to load map to None"""
+        started = time.perf_counter()
+        categories = await self.get_categories()
+        results = await fan_out(
+            lambda category: self.get_articles(category.url),
+            categories,
+            limit=self._crawl_concurrency,
+            timeout=self._crawl_timeout
+        )
+        await self.cache.save()
+        crawled = {}
+        for category, result in zip(categories, results):
+            if isinstance(result, BaseException):
+                log.error(f"Could not load the FAQ category {category.name}: {result!r}")
+                crawled[category.name] = None
                 continue
-            for msg_id in message_ids:
-                message = channel.get_partial_message(msg_id)
-                try:
-                    await message.delete()
-                except (discord.Forbidden, discord.HTTPException):
-                    log.warning("Tried to delete message with no permissions")
-                except discord.NotFound:
-                    log.warning(f"Tried to delete message that did not exist {msg_id}")
-                    pass
-        self.config_settings['faq_messages'] = {}
-        self.save_settings()
+            crawled[category.name] = result
+        log.info(
+            f"Crawled {len(categories)} FAQ categories in {time.perf_counter() - started:.2f}s "
+            f"({self.cache.hits} cached, {self.cache.fetched} fetched, {self.cache.parsed} parsed so far)"
+        )
+        return crawled
+
+    def render_category(self, name: str, articles: List[FaqArticle]) -> discord.Embed:
+        text = ''.join([f"[**{a.name}**]({self.base_url + a.url})\n{a.description}\n\n" for a in articles])
+        return discord.Embed(title=name, description=text)
+
+    def _saved_messages(self) -> Dict[str, Dict[str, List]]:
+        """channel id -> category name -> [message id, fingerprint].
+        Channel ids are strings because that is what they come back as from the settings store.
+        Messages saved by older versions as a plain list of ids get placeholder names that match no category,
+        so the first reconcile replaces them."""
+        saved = {}
+        for channel_id, messages in self.config_settings.get('faq_messages', {}).items():
+            if isinstance(messages, list):
+                messages = {f"#{message_id}": [message_id, None] for message_id in messages}
+            saved[str(channel_id)] = messages
+        return saved
+
+    async def _delete_messages(self, channel: discord.TextChannel, message_ids: List[int]):
+        """Deletes messages with as few API calls as possible.
+        Discord only bulk deletes up to 100 messages younger than 14 days, anything else goes one by one"""
+        if not message_ids:
+            return
+        cutoff = discord.utils.utcnow() - timedelta(days=14) + timedelta(minutes=5)
+        recent = [i for i in message_ids if discord.utils.snowflake_time(i) > cutoff]
+        single = [i for i in message_ids if i not in recent]
+        for start in range(0, len(recent), 100):
+            chunk = recent[start:start + 100]
+            try:
+                await channel.delete_messages([discord.Object(id=i) for i in chunk])
+            except discord.Forbidden:
+                # Bulk deletes need Manage Messages, our own messages can still be deleted one at a time
+                single.extend(chunk)
+            except discord.NotFound:
+                log.warning(f"Some of the old FAQ messages in {channel.id} were already deleted")
+            except discord.HTTPException as e:
+                log.warning(f"Bulk deleting old FAQ messages in {channel.id} failed, deleting them one by one: {e}")
+                single.extend(chunk)
+        for message_id in single:
+            try:
+                await channel.get_partial_message(message_id).delete()
+            except discord.NotFound:
+                log.warning(f"Tried to delete message that did not exist {message_id}")
+            except (discord.Forbidden, discord.HTTPException):
+                log.warning(f"Could not delete old FAQ message {message_id}")
+
+    async def reconcile(self, channel: discord.TextChannel, crawled: Dict[str, Optional[List[FaqArticle]]]):
+        """Brings the FAQ messages in channel in line with the crawled categories.
+        Unchanged categories are left alone, changed ones are edited in place, new ones are posted and
+        categories that disappeared are deleted. A category that failed to load keeps its current message.
+        FAQ messages in any other channel are deleted, the FAQ lives in one channel at a time."""
+        saved = self._saved_messages()
+        current = saved.pop(str(channel.id), {})
+        state: Dict[str, List] = {}
+        edited = posted = 0
+        leftovers = []
+        try:
+            for name, articles in crawled.items():
+                existing = current.get(name)
+                if articles is None:
+                    if existing is not None:
+                        state[name] = current.pop(name)
+                    continue
+                embed = self.render_category(name, articles)
+                fingerprint = embed_fingerprint(embed)
+                if existing is not None:
+                    message_id, old_fingerprint = existing
+                    if old_fingerprint == fingerprint:
+                        state[name] = current.pop(name)
+                        continue
+                    try:
+                        await channel.get_partial_message(message_id).edit(embed=embed)
+                        state[name] = [message_id, fingerprint]
+                        current.pop(name)
+                        edited += 1
+                        continue
+                    except discord.NotFound:
+                        log.info(f"FAQ message {message_id} for {name} is gone, posting it again")
+                        current.pop(name)
+                message = await channel.send(embed=embed)
+                state[name] = [message.id, fingerprint]
+                posted += 1
+
+            leftovers = [message_id for message_id, _ in current.values()]
+            await self._delete_messages(channel, leftovers)
+            current = {}
+            for channel_id, messages in list(saved.items()):
+                other = self.bot.get_channel(int(channel_id))
+                if other is None:
+                    log.warning(f"Tried to delete old messages but could not find channel id {channel_id}")
+                else:
+                    await self._delete_messages(other, [message_id for message_id, _ in messages.values()])
+                del saved[channel_id]
+        finally:
+            # Saved even when Discord fails halfway, so messages that were already posted are not orphaned
+            # and messages that were not handled yet are still found by the next run
+            faq_messages = dict(saved)
+            faq_messages[str(channel.id)] = {**current, **state}
+            self.config_settings['faq_messages'] = faq_messages
+            self.save_settings()
+        log.info(f"FAQ in {channel.id}: {edited} edited, {posted} posted, {len(leftovers)} deleted")
 
     @commands.has_role("Admin")
     @commands.command('faq')
     async def faq(self, ctx: commands.Context):
-        await self._delete_old_messages()
-        categories = await self.get_categories()
-        for category in categories:
-            articles = await self.get_articles(category.url)
-            text = ''.join([f"[**{a.name}**]({self.base_url + a.url})\n{a.description}\n\n" for a in articles])
-            embed = discord.Embed(title=category.name, description=text)
-            message = await ctx.send(embed=embed)
-            self._save_message(message)
-        self.save_settings()
-
+        crawled = await self.crawl()
+        await self.reconcile(ctx.channel, crawled)
 
 
 async def setup(bot):
-    await bot.add_cog(Faq(bot))
+    try:
+        from bot.settings import FAQ_CACHE_PATH, FAQ_CACHE_TTL
+    except ImportError:
+        FAQ_CACHE_PATH = Path(__file__).parents[2] / 'static' / 'faq_cache.json'
+        FAQ_CACHE_TTL = 60 * 60
+    await bot.add_cog(Faq(bot, bot.session, FAQ_CACHE_PATH, FAQ_CACHE_TTL))
 
 
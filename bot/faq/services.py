@@ -1,19 +1,12 @@
-from typing import Optional, List
-from bs4 import BeautifulSoup
-import aiohttp
+from typing import List
 
 from bot.faq.schema import FaqCategory, FaqArticle
+from tft.services import parse_with_soup
 
 
-async def get_html(url: str) -> Optional[str]:
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, raise_for_status=True) as resp:
-            return await resp.text(encoding='utf-8')
-
-
-async def get_faq_categories(html: str) -> List[FaqCategory]:
+def parse_faq_categories(html: str) -> List[FaqCategory]:
     container = []
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = parse_with_soup(html)
 
     for item in soup(class_="g__space"):
         url = item("a")[0]['href']
@@ -23,13 +16,15 @@ async def get_faq_categories(html: str) -> List[FaqCategory]:
         )
     return container
 
-async def get_articles(html: str) -> List[FaqArticle]:
+
+def parse_articles(html: str) -> List[FaqArticle]:
     container = []
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = parse_with_soup(html)
 
     for article_link in soup.find_all("a", class_="t__no-und"):
         url = article_link['href']
         name = article_link.find_next("span", class_="c__primary").text
         description = article_link.find_next("span", class_="paper__preview").text
         container.append(FaqArticle(name=name, url=url, description=description))
-    return container
\ No newline at end of file
+    return container
+
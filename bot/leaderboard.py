@@ -1,14 +1,25 @@
 import asyncio
 import logging
-from copy import deepcopy
-from typing import Optional, Dict, NamedTuple, Union
+import sqlite3
+import time
+from pathlib import Path
+from typing import Optional, Dict, NamedTuple, Union, List
 
 import aiohttp
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 
 from mixins.config import ConfigMixin
-from tft.services import make_leaderboard_embed
+from tft.concurrency import fan_out, SingleFlight
+from tft.deltas import Movement, Snapshot, SnapshotFile, compute_movements, take_snapshot
+from tft.executor import run_blocking
+from tft.history import HistoryStore
+from tft.scheduler import PollScheduler
+from tft.metrics import EDIT_SECONDS, EDITS_SKIPPED, RENDER_SECONDS, TRACKED_GUILDS, CACHE_HIT_RATIO, hit_ratio
+from tft.http import ConditionalFetcher, FetchResult, FetchError
+from tft.schema import LeaderboardEntry
+from tft.services import make_leaderboard_embed, embed_fingerprint, render_leaderboard_table, make_movers_embed, \
+    EmbedCache
 from tft.services import parse_leaderboard
 
 log = logging.getLogger(__name__)
@@ -20,34 +31,56 @@ class MessageInfo(NamedTuple):
 
 
 class LeaderboardCog(ConfigMixin, commands.Cog):
+    # Polling interval the scheduler starts from, and the bounds it adapts it within
     _update_minutes = 10
+    _min_update_minutes = 2
+    _max_update_minutes = 30
+    # Re-send an unchanged embed this often to refresh its timestamp. None disables it.
+    _heartbeat_minutes: Optional[int] = 60
+    # How many message edits may be in flight at once, and how long a single edit may take.
+    # discord.py still queues each request behind its rate limit bucket.
+    _edit_concurrency = 10
+    _edit_timeout = 30
 
-    def __init__(self, bot: commands.Bot):
+    def __init__(
+            self,
+            bot: commands.Bot,
+            session: aiohttp.ClientSession,
+            history: HistoryStore,
+            scheduler: PollScheduler,
+            snapshot_path: Path
+    ):
         super(LeaderboardCog, self).__init__()
         self.bot = bot
+        self.session = session
+        self.history = history
+        self.scheduler = scheduler
+        self.snapshot_file = SnapshotFile(str(snapshot_path))
+        # Rank and return of every entry at the previous poll, for the movement arrows
+        self._previous_snapshot: Optional[Snapshot] = None
+        self._snapshot_board: Optional[str] = None
+        self.movements: List[Movement] = []
+        self.fetcher = ConditionalFetcher(session)
         self.url = "https://leaderboard.thefundedtraderprogram.com"
         self.embed: Optional[discord.Embed] = None
-        self._task: Optional[asyncio.Task] = None
+        self.render_cache = EmbedCache()
+        TRACKED_GUILDS.track(lambda: len(self.config_settings), board='leaderboard')
+        CACHE_HIT_RATIO.track(
+            lambda: hit_ratio(self.render_cache.hits, self.render_cache.misses), cache='leaderboard_render'
+        )
+        self._flight = SingleFlight('leaderboard')
+        self.entries: List[LeaderboardEntry] = []
+        self._last_published = time.monotonic()
+        # message id -> fingerprint of the embed last sent to it
+        self._fingerprints: Dict[int, str] = {}
 
         self.guild_map: Dict[str, MessageInfo] = {}
         self.first_run = True
 
-    def _task_callback(self, future: asyncio.Future):
-        if future.exception():
-            raise future.exception()
-
-    async def _fetch_leaderboard_html(self):
-        """Polls the TFT Website and gets the html response"""
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(self.url) as response:
-                    data = await response.text()
-                    return data
-        except Exception:
-            # The site didn't respond. Wait two minutes and try again
-            log.error(f"Bad response from {self.url}. Retrying in 2 minutes")
-            await asyncio.sleep(120)
-            await self._fetch_leaderboard_html()
+    async def _fetch_leaderboard_html(self) -> FetchResult:
+        """Polls the TFT Website and gets the html response.
+        Raises FetchError when the site could not be reached"""
+        return await self.fetcher.fetch(self.url)
 
     async def _fetch_saved_message(self, guild_id: int, message_info: MessageInfo) -> Optional[discord.PartialMessage]:
         """Fetch the message or update our settings that the message is gone
@@ -76,31 +109,95 @@ class LeaderboardCog(ConfigMixin, commands.Cog):
             old_message = await self._fetch_saved_message(guild_id, old_info)
             if old_message is not None:
                 await self._delete_message(old_message)
+            self._fingerprints.pop(old_info.message_id, None)
         self.config_settings[str(guild_id)] = message_info
+        self._fingerprints[message_info.message_id] = embed_fingerprint(self.embed)
         self.save_settings()
 
-    async def _update_guild_message(self, guild_id: int, message_info: MessageInfo, embed: discord.Embed):
-        """Updates the embed with the new polled information."""
+    async def _update_guild_message(
+            self,
+            guild_id: int,
+            message_info: MessageInfo,
+            embed: discord.Embed,
+            force: bool = False
+    ):
+        """Updates the embed with the new polled information.
+        The edit is skipped when the message already shows the same content unless force is set."""
+        fingerprint = embed_fingerprint(embed)
+        if not force and self._fingerprints.get(message_info.message_id) == fingerprint:
+            EDITS_SKIPPED.inc(board='leaderboard')
+            return
         message = await self._fetch_saved_message(guild_id, message_info)
         if message is None:
             del self.config_settings[str(guild_id)]
+            self._fingerprints.pop(message_info.message_id, None)
             self.save_settings()
             return
         try:
-            await message.edit(embed=embed)
+            with EDIT_SECONDS.time(board='leaderboard'):
+                await message.edit(embed=embed)
+            self._fingerprints[message_info.message_id] = fingerprint
         except discord.NotFound:
             del self.config_settings[str(guild_id)]
+            self._fingerprints.pop(message_info.message_id, None)
             self.save_settings()
 
 
-    async def update(self):
-        """Fetches HTML from TFT and parses it, and generates an embed."""
+    async def update(self) -> bool:
+        """Refreshes the data. Callers arriving while a refresh is running wait for it and share its result"""
+        return await self._flight.do('update', self._update)
+
+    async def _update(self) -> bool:
+        """Fetches HTML from TFT and parses it, and generates an embed.
+        Returns False when the page has not changed since the last poll and the last good embed was kept as is.
+        Raises FetchError when the page could not be fetched."""
         log.info("Updating Embed from TFT site.")
-        html = await self._fetch_leaderboard_html()
-        entries = parse_leaderboard(html)
-        embed = make_leaderboard_embed(entries)
-        embed.set_footer(text=f"Updated every {self._update_minutes} minutes")
-        self.embed = embed
+        try:
+            result = await self._fetch_leaderboard_html()
+        except FetchError as e:
+            log.error(f"Could not fetch the leaderboard. Keeping the last good data. {e}")
+            raise
+        if not result.changed and self.embed is not None:
+            log.info("Leaderboard unchanged since last poll.")
+            return False
+        entries = await run_blocking(parse_leaderboard, result.text)
+        if not entries:
+            log.error(f"No leaderboard entries found on {self.url}. Keeping the last good data.")
+            return False
+        self.entries = entries
+        await self._track_movements('leaderboard')
+        self.embed = await self._render_embed()
+        await self._record_history('leaderboard')
+        return True
+
+    async def _track_movements(self, board: str):
+        """Works out how every entry moved since the previous poll and persists the new snapshot"""
+        if self._previous_snapshot is None or self._snapshot_board != board:
+            self._previous_snapshot = await asyncio.to_thread(self.snapshot_file.load, board)
+            self._snapshot_board = board
+        self.movements = compute_movements(self._previous_snapshot, self.entries)
+        self._previous_snapshot = take_snapshot(self.entries)
+        try:
+            await asyncio.to_thread(self.snapshot_file.save, board, self._previous_snapshot)
+        except IOError as e:
+            log.error(f"Could not save the {board} snapshot: {e}")
+
+    async def _record_history(self, board: str):
+        try:
+            await asyncio.to_thread(self.history.record, board, self.entries)
+        except sqlite3.Error as e:
+            log.error(f"Could not record {board} history: {e}")
+
+    async def _render_embed(self) -> discord.Embed:
+        key = EmbedCache.key('leaderboard', self.entries, self.movements, self._update_minutes)
+        embed = self.render_cache.get(key)
+        if embed is None:
+            with RENDER_SECONDS.time(board='leaderboard'):
+                table = await run_blocking(render_leaderboard_table, self.entries, self.movements)
+                embed = make_leaderboard_embed(self.entries, table=table)
+                embed.set_footer(text=f"Updated every {self._update_minutes} minutes")
+            self.render_cache.put(key, embed)
+        return embed
 
     def get_saved_message_info(self, guild_id: int) -> Optional[MessageInfo]:
         """Helper function that converts our dictionary back to a Named Tuple.
@@ -113,26 +210,53 @@ class LeaderboardCog(ConfigMixin, commands.Cog):
             return MessageInfo(channel_id=o[0], message_id=o[1])
         return o
 
-    @tasks.loop(minutes=_update_minutes, reconnect=True)
-    async def update_task(self):
-        """The actual polling task. To change the time, change _update_minutes at the top of this file"""
+    async def poll(self) -> bool:
+        """Called by the bot's poll scheduler. Returns whether the data changed so it can adapt the interval.
+        Raises FetchError when the site could not be reached, which the scheduler counts as a failure and backs off from.
+        To change the base interval, change _update_minutes at the top of this file"""
         await self.bot.wait_until_ready()
-        await self.update()
-        for guild_id in deepcopy(list(self.config_settings.keys())):
-            guild_id = int(guild_id)
+        heartbeat = bool(self._heartbeat_minutes) and \
+            time.monotonic() - self._last_published >= self._heartbeat_minutes * 60
+        changed = await self.update()
+        if not changed:
+            if not heartbeat or not self.entries:
+                return False
+            self.embed = await self._render_embed()
+        embed = self.embed
+        self._last_published = time.monotonic()
+
+        async def publish(guild_id: int):
             message_info = self.get_saved_message_info(guild_id)
-            await self._update_guild_message(guild_id, message_info, self.embed)
+            await self._update_guild_message(guild_id, message_info, embed, force=heartbeat)
+
+        guild_ids = [int(guild_id) for guild_id in self.config_settings.keys()]
+        started = time.perf_counter()
+        results = await fan_out(publish, guild_ids, limit=self._edit_concurrency, timeout=self._edit_timeout)
+        failed = 0
+        for guild_id, result in zip(guild_ids, results):
+            if isinstance(result, asyncio.TimeoutError):
+                failed += 1
+                log.warning(f"Timed out updating message in guild {guild_id}")
+            elif isinstance(result, Exception):
+                failed += 1
+                log.error(f"Failed to update message in guild {guild_id}: {result}")
+        log.info(f"Updated {len(guild_ids)} guild messages in {time.perf_counter() - started:.2f}s ({failed} failed)")
+        return changed
 
     async def cog_load(self) -> None:
-        """Waits until the cache is loaded with guilds and then launches our task process"""
-        await self.bot.wait_until_ready()
-        log.info("Starting TFT Polling Task")
-        self._task = self.update_task.start()
-        self._task.add_done_callback(self._task_callback)
+        """Registers our polling with the bot's scheduler"""
+        log.info("Registering TFT leaderboard polling")
+        self.scheduler.register(
+            'leaderboard',
+            self.poll,
+            interval=self._update_minutes * 60,
+            min_interval=self._min_update_minutes * 60,
+            max_interval=self._max_update_minutes * 60,
+            url=self.url
+        )
 
     async def cog_unload(self) -> None:
-        if not self._task.done():
-            self._task.cancel()
+        self.scheduler.unregister('leaderboard')
 
     @commands.has_role("Admin")
     @commands.command(name='leaderboard')
@@ -140,12 +264,27 @@ class LeaderboardCog(ConfigMixin, commands.Cog):
         """Fetches the Top 10 Leaderboard information from The Funded Trader"""
         await ctx.trigger_typing()
         if self.embed is None:
-            await self.update()
+            try:
+                await self.update()
+            except FetchError:
+                pass
 
+        if self.embed is None:
+            await ctx.send("The leaderboard is unavailable right now.")
+            return
         message = await ctx.send(embed=self.embed)
         message_info = MessageInfo(channel_id=ctx.channel.id, message_id=message.id)
         await self._new_message(ctx.guild.id, message_info)
 
+    @commands.has_role("Admin")
+    @commands.command(name='movers')
+    async def movers_cmd(self, ctx: commands.Context):
+        """Lists the traders whose rank or return changed since the previous update"""
+        if not self.movements:
+            await ctx.send("No movements recorded yet.")
+            return
+        await ctx.send(embed=make_movers_embed("Leaderboard Movers", self.movements))
+
     @leaderboard_cmd.error
     async def leaderboard_error(self, ctx, error):
         name = ctx.author.display_name
@@ -157,4 +296,9 @@ class LeaderboardCog(ConfigMixin, commands.Cog):
             log.error(error)
 
 async def setup(bot: commands.Bot):
-    await bot.add_cog(LeaderboardCog(bot))
+    default = Path(__file__).parents[1] / 'static'
+    try:
+        from bot.settings import SNAPSHOT_DIR
+    except ImportError:
+        SNAPSHOT_DIR = default
+    await bot.add_cog(LeaderboardCog(bot, bot.session, bot.history, bot.scheduler, SNAPSHOT_DIR / 'last_leaderboard.json'))
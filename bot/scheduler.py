@@ -0,0 +1,72 @@
+import logging
+from typing import Optional
+
+from discord.ext import commands
+from tabulate import tabulate, simple_separated_format
+
+from tft.concurrency import single_flight_stats
+from tft.scheduler import PollScheduler
+from tft.services import markdown_syntax
+
+log = logging.getLogger(__name__)
+
+
+def _minutes(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "-"
+    if seconds < 60:
+        return f"{seconds:.0f}s"
+    return f"{seconds / 60:.1f}m"
+
+
+class SchedulerCog(commands.Cog):
+    def __init__(self, bot: commands.Bot, scheduler: PollScheduler):
+        self.bot = bot
+        self.scheduler = scheduler
+
+    @commands.has_role("Admin")
+    @commands.command(name='scheduler')
+    async def scheduler_cmd(self, ctx: commands.Context, poll: Optional[str] = None):
+        """Shows every polled source with its current interval. `!scheduler <name>` polls that source right away"""
+        if poll is not None:
+            if poll not in self.scheduler.sources:
+                await ctx.send(f"No poll source named {poll}.")
+                return
+            self.scheduler.poll_now(poll)
+            await ctx.send(f"Polling {poll} now.")
+            return
+        rows = [
+            [
+                row['name'],
+                row['state'],
+                _minutes(row['interval']),
+                _minutes(row['next_in']),
+                f"{row['changes']}/{row['runs']}",
+                row['failures'],
+                _minutes(row['last_duration']),
+                _minutes(row['backoff']) if row['backoff'] else "-",
+            ]
+            for row in self.scheduler.describe()
+        ]
+        if not rows:
+            await ctx.send("Nothing is being polled.")
+            return
+        header = ["Source", "State", "Every", "Next", "Changed", "Failed", "Took", "Backoff"]
+        table = tabulate(rows, headers=header, tablefmt=simple_separated_format('  '))
+        # Refreshes and fetches that concurrent callers shared instead of repeating
+        shared = [[name, calls, coalesced] for name, (calls, coalesced) in sorted(single_flight_stats().items())]
+        if shared:
+            shared_table = tabulate(shared, headers=["Shared", "Calls", "Coalesced"], tablefmt=simple_separated_format('  '))
+            table = f"{table}\n\n{shared_table}"
+        await ctx.send(markdown_syntax("css", table))
+
+    @scheduler_cmd.error
+    async def scheduler_error(self, ctx, error):
+        if isinstance(error, commands.MissingRole):
+            log.warning(f"{ctx.author.display_name} tried to use !scheduler in guild: {ctx.guild.name} without the Admin role")
+        else:
+            log.error(error)
+
+
+async def setup(bot: commands.Bot):
+    await bot.add_cog(SchedulerCog(bot, bot.scheduler))
@@ -1,2 +1,44 @@
 from pathlib import Path
 ANNOUNCEMENT_DIR: Path = Path(__file__).parents[1] / "static/"
+
+# Shared HTTP client
+HTTP_CONNECTION_LIMIT: int = 100
+HTTP_CONNECTION_LIMIT_PER_HOST: int = 10
+HTTP_DNS_CACHE_TTL: int = 300
+HTTP_KEEPALIVE_TIMEOUT: float = 60
+HTTP_TOTAL_TIMEOUT: float = 30
+HTTP_CONNECT_TIMEOUT: float = 10
+
+# BeautifulSoup tree builder: html.parser, lxml or html5lib.
+# lxml is faster, tests/test_parsers.py checks that it reads the saved TFT pages the same as html.parser.
+HTML_PARSER_BACKEND: str = "html.parser"
+
+# Pool for CPU bound parsing and rendering: "thread" or "process"
+EXECUTOR_KIND: str = "thread"
+EXECUTOR_WORKERS: int = 2
+
+# Where cog settings are stored: "json" (static/settings.json) or "sqlite" (static/settings.db).
+# To opt in to sqlite, set this to "sqlite". The first start imports the existing settings.json and renames it to
+# settings.json.bak. To go back to json, rename settings.json.bak to settings.json.
+SETTINGS_BACKEND: str = "json"
+# Seconds to collect settings changes before writing them out together
+SETTINGS_FLUSH_DELAY: float = 2.0
+
+# SQLite file that keeps the history of every polled board
+HISTORY_PATH: Path = Path(__file__).parents[1] / "static/history.db"
+
+# Directory for the last snapshot of each board, used to show rank movements across restarts
+SNAPSHOT_DIR: Path = Path(__file__).parents[1] / "static/"
+
+# Minimum seconds between the start of two polls, so sources registered with the scheduler do not fetch in bursts
+POLL_SPACING: float = 5.0
+
+# Parsed help center pages for !faq. Pages younger than the TTL (seconds) are not requested again,
+# older ones are revalidated with the validators the site handed out.
+FAQ_CACHE_PATH: Path = Path(__file__).parents[1] / "static/faq_cache.json"
+FAQ_CACHE_TTL: float = 60 * 60
+
+# Prometheus metrics on http://METRICS_HOST:METRICS_PORT/metrics. Off unless enabled here.
+METRICS_ENABLED: bool = False
+METRICS_HOST: str = "127.0.0.1"
+METRICS_PORT: int = 9108
@@ -1,88 +1,247 @@
+import asyncio
 import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from atomicwrites import atomic_write
 import json
 import collections
 import logging
 import typing
 
+from tft.metrics import CONFIG_KEYS
+
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '../', 'static'))
 FILE_PATH = os.path.normpath(f'{BASE_DIR}/settings.json')
+DB_PATH = os.path.normpath(f'{BASE_DIR}/settings.db')
 
 log = logging.getLogger(__name__)
 
-class ConfigMixin:
-    """Mixin that will help aid adding configuration parameters
-    that can be easily serialized to disk
-    """
-    def __init__(self):
-        super(ConfigMixin, self).__init__()
-        self._config = collections.defaultdict(dict)
-        self.parent_key = str(self.__class__.__name__)
-        self.config_settings = collections.defaultdict(dict)
-
-        if not os.path.exists(BASE_DIR):
-            os.makedirs(BASE_DIR)
 
-        if not os.path.exists(FILE_PATH):
-            self._config[self.parent_key] = {}
+class JsonSettingsStore:
+    """Keeps every cog's settings in a single JSON document.
+    Each save re-reads the file and rewrites all of it on a background thread."""
 
-        self._load_configuration()
+    def __init__(self, path: str = FILE_PATH):
+        self.path = path
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='settings-writer')
 
+    def _read(self) -> typing.Dict[str, typing.Any]:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except IOError:
+            # File does not exist
+            return {}
 
+    def load_section(self, section: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        config = self._read()
+        if not os.path.exists(self.path):
+            with atomic_write(self.path, overwrite=True) as f:
+                json.dump({section: {}}, f)
+        return config.get(section)
 
-    def _load_configuration(self) -> None:
-        """
-        Reloads the configuration into the main dictionary object
-        Parameters
-        ----------
-        path
+    def save_sections(self, sections: typing.Dict[str, typing.Dict[str, typing.Any]]):
+        # Snapshot now so later changes to the live dictionaries do not leak into this write
+        snapshot = json.loads(json.dumps(sections))
+        self._writer.submit(self._write, snapshot)
 
-        Returns
-        -------
+    def _write(self, sections: typing.Dict[str, typing.Dict[str, typing.Any]]):
+        try:
+            # Read in the most recent contents in case another process altered.
+            config = self._read()
+            config.update(sections)
+            # Write out the updated contents
+            with atomic_write(self.path, overwrite=True) as f:
+                json.dump(config, f)
+        except (IOError, ValueError) as e:
+            log.error(f"Could not persist settings: {e}")
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+
+
+class SqliteSettingsStore:
+    """Keeps settings in SQLite with one row per (section, key).
+
+    Saving a section only upserts the keys whose JSON encoding changed since the last successful write and deletes
+    the keys that were removed. The database runs in WAL mode and all writes happen on a single background
+    thread, so save_section returns without waiting on the disk. A write that fails is retried with the next save.
+    The first time the database is created the existing settings.json is imported and renamed to settings.json.bak.
+    """
 
-        """
+    def __init__(self, path: str = DB_PATH, json_path: str = FILE_PATH):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS settings ("
+            "section TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (section, key))"
+        )
+        self._connection.commit()
+        # section -> key -> json value as last written to the database
+        self._persisted: typing.Dict[str, typing.Dict[str, str]] = collections.defaultdict(dict)
+        # The connection and _persisted are shared by the event loop (loads) and the writer thread
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='settings-writer')
+        self._migrate_json(json_path)
+
+    def _migrate_json(self, json_path: str):
+        empty = self._connection.execute("SELECT 1 FROM settings LIMIT 1").fetchone() is None
+        if not empty or not os.path.exists(json_path):
+            return
+        with open(json_path, 'r') as f:
+            config = json.load(f)
+        rows = [
+            (section, str(key), json.dumps(value))
+            for section, settings in config.items()
+            for key, value in settings.items()
+        ]
+        with self._connection:
+            self._connection.executemany("INSERT INTO settings (section, key, value) VALUES (?, ?, ?)", rows)
+        os.replace(json_path, f'{json_path}.bak')
+        log.info(f"Migrated {len(rows)} settings from {json_path} to {self.path}")
+
+    def load_section(self, section: str) -> typing.Optional[typing.Dict[str, typing.Any]]:
+        with self._lock:
+            rows = self._connection.execute("SELECT key, value FROM settings WHERE section = ?", (section,)).fetchall()
+            self._persisted[section] = dict(rows)
+        if not rows:
+            return None
+        return {key: json.loads(value) for key, value in rows}
+
+    def save_sections(self, sections: typing.Dict[str, typing.Dict[str, typing.Any]]):
+        for section, settings in sections.items():
+            self.save_section(section, settings)
+
+    def save_section(self, section: str, settings: typing.Dict[str, typing.Any]):
+        # Encode now so later changes to the live dictionary do not leak into this write
+        encoded = {str(key): json.dumps(value) for key, value in settings.items()}
+        self._writer.submit(self._write, section, encoded)
+
+    def _write(self, section: str, encoded: typing.Dict[str, str]):
+        # Diffed here rather than in save_section so every save is compared with what actually got committed
+        with self._lock:
+            persisted = self._persisted[section]
+            upserts = [(section, key, value) for key, value in encoded.items() if persisted.get(key) != value]
+            deletes = [(section, key) for key in persisted.keys() if key not in encoded]
+            if not upserts and not deletes:
+                return
+            try:
+                with self._connection:
+                    self._connection.executemany(
+                        "INSERT INTO settings (section, key, value) VALUES (?, ?, ?) "
+                        "ON CONFLICT (section, key) DO UPDATE SET value = excluded.value",
+                        upserts
+                    )
+                    self._connection.executemany("DELETE FROM settings WHERE section = ? AND key = ?", deletes)
+            except sqlite3.Error as e:
+                log.error(f"Could not persist settings: {e}")
+                return
+            self._persisted[section] = encoded
+        log.debug(f"settings: {len(upserts)} upserted, {len(deletes)} deleted")
+
+    def close(self):
+        self._writer.shutdown(wait=True)
+        with self._lock:
+            self._connection.close()
+
+
+class ConfigRegistry:
+    """Single in-memory copy of every cog's settings.
+
+    Each ConfigMixin gets its section from here, so all cogs share one loaded configuration.
+    save() only marks a section dirty; the dirty sections are written together in one call to the store
+    once ``flush_delay`` seconds have passed, so a burst of saves during an update cycle costs a single write.
+    """
+    def __init__(self, store, flush_delay: float = 2.0):
+        self.store = store
+        self.flush_delay = flush_delay
+        self._sections: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        self._dirty: typing.Set[str] = set()
+        self._flush_handle: typing.Optional[asyncio.TimerHandle] = None
+
+    def section(self, name: str) -> typing.Dict[str, typing.Any]:
+        if name not in self._sections:
+            settings = self.store.load_section(name)
+            self._sections[name] = settings if settings is not None else collections.defaultdict(dict)
+        return self._sections[name]
+
+    def save(self, name: str, settings: typing.Dict[str, typing.Any]):
+        self._sections[name] = settings
+        self._dirty.add(name)
+        if self._flush_handle is not None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Nothing to schedule on outside of the event loop
+            self.flush()
+            return
+        self._flush_handle = loop.call_later(self.flush_delay, self.flush)
+
+    def flush(self):
+        """Writes every dirty section to the store now"""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._dirty:
+            return
+        sections = {name: self._sections[name] for name in self._dirty}
+        self._dirty.clear()
+        log.debug(f"Flushing settings for {', '.join(sections.keys())}")
+        self.store.save_sections(sections)
+
+
+SETTINGS_BACKENDS = {
+    'json': JsonSettingsStore,
+    'sqlite': SqliteSettingsStore,
+}
+_registry: typing.Optional[ConfigRegistry] = None
+
+
+def get_registry() -> ConfigRegistry:
+    """Returns the registry shared by every ConfigMixin, creating it and its store on first use"""
+    global _registry
+    if _registry is None:
         try:
-            with open(FILE_PATH, 'r') as f:
-                self._config = json.load(f)
-            if not self.config_settings:
-                self.config_settings = self._config[self.parent_key]
+            from bot.settings import SETTINGS_BACKEND, SETTINGS_FLUSH_DELAY
+        except ImportError:
+            SETTINGS_BACKEND = 'json'
+            SETTINGS_FLUSH_DELAY = 2.0
+        if not os.path.exists(BASE_DIR):
+            os.makedirs(BASE_DIR)
+        _registry = ConfigRegistry(SETTINGS_BACKENDS[SETTINGS_BACKEND](), SETTINGS_FLUSH_DELAY)
+    return _registry
 
-        except KeyError:
-            pass
 
-        except IOError:
-            # File does not exist
-            with atomic_write(FILE_PATH, overwrite=True) as f:
-                self._config[self.parent_key] = {}
-                json.dump(self._config, f)
+def close_store():
+    """Flushes pending settings, waits for the writes to finish and releases the store"""
+    global _registry
+    if _registry is not None:
+        _registry.flush()
+        _registry.store.close()
+        _registry = None
+
+
+class ConfigMixin:
+    """Mixin that will help aid adding configuration parameters
+    that can be easily serialized to disk
+    """
+    def __init__(self):
+        super(ConfigMixin, self).__init__()
+        self.parent_key = str(self.__class__.__name__)
+        self.config_settings = get_registry().section(self.parent_key)
+        CONFIG_KEYS.track(lambda: len(self.config_settings), section=self.parent_key)
 
     def save_settings(self):
         """
-        Persists the settings to disk
+        Marks the settings for persisting to disk. The write happens shortly after in the background
         Returns
         -------
 
         """
-        # Read in the most recent contents in case another process altered.
-        self._load_configuration()
-        self._config[self.parent_key] = self.config_settings
         log.debug(f'mixin config: {self.config_settings}')
-
-        # Write out the updated contents
-        with atomic_write(FILE_PATH, overwrite=True) as f:
-            json.dump(self._config, f)
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        get_registry().save(self.parent_key, self.config_settings)
@@ -0,0 +1,37 @@
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup
+
+from tft.services import CompetitionLabelExtractor, get_competition_label
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+LABELS = ('prize pool', 'remaining contestants', 'start date', 'account size', 'total contestants', 'missing')
+
+
+def extract(html: str, chunk_size: int):
+    extractor = CompetitionLabelExtractor(LABELS)
+    for start in range(0, len(html), chunk_size):
+        extractor.feed(html[start:start + chunk_size])
+    extractor.close()
+    return {label: extractor.found.get(label) for label in LABELS}
+
+
+@pytest.mark.parametrize('fixture', ['competition_details.html', 'competition_details_broken.html'])
+@pytest.mark.parametrize('chunk_size', [1, 7, 16384])
+def test_extractor_matches_the_soup_lookup(fixture, chunk_size):
+    html = (FIXTURES / fixture).read_text(encoding='utf-8')
+    soup = BeautifulSoup(html, 'html.parser')
+    expected = {label: get_competition_label(soup, label) for label in LABELS}
+    assert extract(html, chunk_size) == expected
+
+
+def test_unclosed_tags_do_not_swallow_later_labels():
+    html = (FIXTURES / 'competition_details_broken.html').read_text(encoding='utf-8')
+    found = extract(html, 16384)
+    assert found['start date'] == 'Apr 1, 2022'
+    assert found['prize pool'] == '$50,000'
+    # The value block before the title is the first one after the label element
+    assert found['remaining contestants'] == '4,812'
+    # Titles are compared as is, like get_competition_label does
+    assert found['account size'] is None
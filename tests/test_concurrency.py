@@ -0,0 +1,50 @@
+import asyncio
+
+from tft.concurrency import SingleFlight
+
+
+def test_shared_call_survives_one_cancelled_caller():
+    async def scenario():
+        flight = SingleFlight('test')
+        release = asyncio.Event()
+
+        async def work():
+            await release.wait()
+            return 42
+
+        first = asyncio.ensure_future(flight.do('key', work))
+        second = asyncio.ensure_future(flight.do('key', work))
+        await asyncio.sleep(0)
+        first.cancel()
+        await asyncio.sleep(0)
+        release.set()
+        assert await second == 42
+        assert first.cancelled()
+        assert (flight.calls, flight.coalesced) == (1, 1)
+
+    asyncio.run(scenario())
+
+
+def test_shared_call_is_cancelled_with_its_last_caller():
+    async def scenario():
+        flight = SingleFlight('test')
+        started = asyncio.Event()
+        cancelled = asyncio.Event()
+
+        async def work():
+            started.set()
+            try:
+                await asyncio.sleep(60)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        callers = [asyncio.ensure_future(flight.do('key', work)) for _ in range(2)]
+        await started.wait()
+        for caller in callers:
+            caller.cancel()
+        await asyncio.gather(*callers, return_exceptions=True)
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert not flight._in_flight
+
+    asyncio.run(scenario())
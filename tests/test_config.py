@@ -0,0 +1,42 @@
+import sqlite3
+
+from mixins.config import SqliteSettingsStore
+
+
+class FlakyConnection:
+    """Wraps a connection and fails the next write"""
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+        self.fail = True
+
+    def __enter__(self):
+        return self.connection.__enter__()
+
+    def __exit__(self, *exc):
+        return self.connection.__exit__(*exc)
+
+    def executemany(self, sql, rows):
+        if self.fail:
+            self.fail = False
+            raise sqlite3.OperationalError("database is locked")
+        return self.connection.executemany(sql, rows)
+
+    def execute(self, *args):
+        return self.connection.execute(*args)
+
+    def close(self):
+        self.connection.close()
+
+
+def test_failed_write_is_retried_by_the_next_save(tmp_path):
+    store = SqliteSettingsStore(str(tmp_path / 'settings.db'), json_path=str(tmp_path / 'settings.json'))
+    store._connection = FlakyConnection(store._connection)
+    store.save_section('Cog', {'1': [2, 3]})
+    store._writer.submit(lambda: None).result()
+    assert store._connection.execute("SELECT COUNT(*) FROM settings").fetchone() == (0,)
+
+    store.save_section('Cog', {'1': [2, 3]})
+    store.close()
+    reopened = SqliteSettingsStore(str(tmp_path / 'settings.db'), json_path=str(tmp_path / 'settings.json'))
+    assert reopened.load_section('Cog') == {'1': [2, 3]}
+    reopened.close()
@@ -0,0 +1,18 @@
+from datetime import datetime, timezone
+
+from tft.history import HistoryStore
+from tft.schema import LeaderboardEntry
+
+TAKEN_AT = datetime(2022, 4, 1, tzinfo=timezone.utc)
+
+
+def entry(rank: int, name: str) -> LeaderboardEntry:
+    return LeaderboardEntry(rank=rank, name=name, roi=f'{10 - rank}%', profit='$1,000')
+
+
+def test_traders_sharing_a_nickname_keep_their_rows(tmp_path):
+    store = HistoryStore(str(tmp_path / 'history.db'))
+    store.record('leaderboard', [entry(1, 'twin'), entry(2, 'solo'), entry(3, 'twin')], TAKEN_AT)
+    assert [point.rank for point in store.trader_history('twin', 'leaderboard')] == [1, 3]
+    store.close()
+
@@ -0,0 +1,114 @@
+import asyncio
+import json
+
+import aiohttp
+import pytest
+from aiohttp import web
+
+from tft.http import CircuitBreaker, ConditionalFetcher, FetchError, RetryPolicy, call_with_policy, get_breaker
+
+POLICY = RetryPolicy(max_attempts=2, base_delay=0, max_delay=0)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+@pytest.fixture
+def breaker():
+    url = 'https://breaker.test/page'
+    breaker = get_breaker(url)
+    breaker.failures = 0
+    breaker.opened_at = None
+    breaker.release()
+    return url, breaker
+
+
+def open_breaker(breaker: CircuitBreaker):
+    for _ in range(breaker.failure_threshold):
+        breaker.record_failure()
+    breaker.opened_at -= breaker.reset_timeout
+
+
+def test_non_retryable_errors_are_raised_as_fetch_errors(breaker):
+    url, breaker = breaker
+    breaker.failures = 2
+
+    async def bad_json():
+        return json.loads('<html>')
+
+    with pytest.raises(FetchError) as info:
+        run(call_with_policy(url, bad_json, POLICY))
+    assert isinstance(info.value.__cause__, json.JSONDecodeError)
+    # A parse error is not a sign that the host is healthy
+    assert breaker.failures == 2
+
+
+def test_non_retryable_error_ends_the_half_open_trial(breaker):
+    url, breaker = breaker
+    open_breaker(breaker)
+    assert breaker.state == 'half-open'
+
+    async def missing_key():
+        return {}['data']
+
+    with pytest.raises(FetchError):
+        run(call_with_policy(url, missing_key, POLICY))
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+
+
+def test_cancelled_trial_lets_the_next_request_through(breaker):
+    url, breaker = breaker
+    open_breaker(breaker)
+
+    async def cancel_trial():
+        started = asyncio.Event()
+
+        async def hang():
+            started.set()
+            await asyncio.sleep(60)
+
+        task = asyncio.ensure_future(call_with_policy(url, hang, POLICY))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    run(cancel_trial())
+    assert breaker.state == 'half-open'
+    assert breaker.allow()
+
+
+def test_stream_revalidates_with_the_last_etag():
+    requests = []
+
+    async def details(request: web.Request) -> web.Response:
+        requests.append(request.headers.get('If-None-Match'))
+        if request.headers.get('If-None-Match') == '"v1"':
+            return web.Response(status=304)
+        return web.Response(text='<p>prize</p>', headers={'ETag': '"v1"'})
+
+    async def consume(response):
+        return await response.text()
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/details', details)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with aiohttp.ClientSession() as session:
+                fetcher = ConditionalFetcher(session, POLICY)
+                url = f'http://127.0.0.1:{port}/details'
+                return [await fetcher.stream(url, consume) for _ in range(2)]
+        finally:
+            await runner.cleanup()
+
+    first, second = run(scenario())
+    assert requests == [None, '"v1"']
+    assert first == ('<p>prize</p>', True)
+    assert second == ('<p>prize</p>', False)
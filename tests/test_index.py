@@ -0,0 +1,24 @@
+from tft.index import TraderIndex
+from tft.schema import CompetitionEntry
+
+
+def entry(rank: int, name: str) -> CompetitionEntry:
+    return CompetitionEntry(rank=rank, name=name, roi='1%', back='1%', prize='-')
+
+
+def test_nicknames_that_differ_by_case_are_all_kept():
+    index = TraderIndex()
+    index.update([entry(1, 'Alpha'), entry(2, 'ALPHA'), entry(3, 'beta')])
+    assert len(index) == 3
+    assert [e.name for e in index.lookup('alpha')] == ['Alpha', 'ALPHA']
+    index.update([entry(1, 'ALPHA'), entry(2, 'beta')])
+    assert [e.name for e in index.lookup('alpha')] == ['ALPHA']
+
+
+def test_prefix_returns_the_best_ranked_matches():
+    index = TraderIndex()
+    # Alphabetically first is ranked last, so a scan that stops at limit keys would miss the leaders
+    index.update([entry(1, 'trader_z'), entry(2, 'trader_y'), entry(3, 'zed'), entry(4, 'trader_a')])
+    assert [e.rank for e in index.prefix('trader', limit=2)] == [1, 2]
+    assert [e.rank for e in index.prefix('TRADER_')] == [1, 2, 4]
+    assert index.prefix('nobody') == []
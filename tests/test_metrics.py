@@ -0,0 +1,34 @@
+import asyncio
+import logging
+
+import aiohttp
+from aiohttp import web
+
+from tft.metrics import RATE_LIMITED, discord_rate_limit_trace
+
+
+def test_discord_429s_are_counted_from_the_http_client():
+    async def api(request: web.Request) -> web.Response:
+        return web.Response(status=429 if request.query.get('limited') else 200)
+
+    async def scenario():
+        app = web.Application()
+        app.router.add_get('/api', api)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        try:
+            async with aiohttp.ClientSession(trace_configs=[discord_rate_limit_trace()]) as session:
+                for query in ('?limited=1', '', '?limited=1'):
+                    async with session.get(f'http://127.0.0.1:{port}/api{query}'):
+                        pass
+        finally:
+            await runner.cleanup()
+
+    level = logging.getLogger('discord.http').level
+    before = RATE_LIMITED._values.get(('discord',), 0)
+    asyncio.run(scenario())
+    assert RATE_LIMITED._values.get(('discord',), 0) - before == 2
+    assert logging.getLogger('discord.http').level == level
@@ -0,0 +1,90 @@
+from pathlib import Path
+
+import pytest
+from bs4 import BeautifulSoup, SoupStrainer
+
+from bot.faq.services import parse_faq_categories, parse_articles
+from tft.schema import LeaderboardEntry, CompetitionEntry
+from tft.services import set_parser_backend, parse_with_soup, parse_leaderboard, find_active_competition, \
+    get_competition_label, parse_competition
+
+FIXTURES = Path(__file__).parent / 'fixtures'
+BACKENDS = ('html.parser', 'lxml')
+
+
+def read_fixture(name: str) -> str:
+    return (FIXTURES / name).read_text(encoding='utf-8')
+
+
+@pytest.fixture(autouse=True)
+def restore_backend():
+    yield
+    set_parser_backend('html.parser')
+
+
+def parse_with_each_backend(parse, html):
+    results = {}
+    for backend in BACKENDS:
+        assert set_parser_backend(backend) == backend
+        results[backend] = parse(html)
+    return results
+
+
+def test_leaderboard_is_the_same_for_every_backend():
+    results = parse_with_each_backend(parse_leaderboard, read_fixture('leaderboard.html'))
+    assert results['lxml'] == results['html.parser']
+    entries = results['html.parser']
+    assert [type(entry) for entry in entries] == [LeaderboardEntry] * 5
+    assert entries[0] == LeaderboardEntry(rank=1, name='GoldenBull', roi='182.41%', profit='$364,820.00')
+    assert entries[1].name == 'Trader & Co'
+    assert entries[4].name == '<script>'
+
+
+def test_leaderboard_strainer_only_keeps_table_cells():
+    html = read_fixture('leaderboard.html')
+    for backend in BACKENDS:
+        set_parser_backend(backend)
+        strained = parse_with_soup(html, parse_only=SoupStrainer("td"))
+        assert strained.find(['th', 'nav', 'footer']) is None
+        assert [td.text for td in strained("td")] == [td.text for td in BeautifulSoup(html, backend)("td")]
+
+
+def test_active_competition_is_the_same_for_every_backend():
+    results = parse_with_each_backend(find_active_competition, read_fixture('competition_list.html'))
+    assert results['lxml'] == results['html.parser'] == '123'
+
+
+def test_competition_labels_are_the_same_for_every_backend():
+    def labels(html):
+        soup = parse_with_soup(html)
+        return [get_competition_label(soup, label) for label in ('prize pool', 'Remaining Contestants', 'missing')]
+
+    results = parse_with_each_backend(labels, read_fixture('competition_details.html'))
+    assert results['lxml'] == results['html.parser'] == ['$50,000', '3,977', None]
+
+
+def test_competition_rankings_are_the_same_for_every_backend():
+    results = parse_with_each_backend(
+        lambda html: parse_competition(parse_with_soup(html)), read_fixture('competition_details.html'))
+    assert results['lxml'] == results['html.parser']
+    entries = results['html.parser']
+    assert [type(entry) for entry in entries] == [CompetitionEntry] * 5
+    assert entries[1] == CompetitionEntry(rank=2, name='Trader & Co', roi='38.75%', back='$277,500', prize='$7,500')
+    assert entries[4].name == '<b>bold</b>'
+
+
+def test_faq_categories_are_the_same_for_every_backend():
+    results = parse_with_each_backend(parse_faq_categories, read_fixture('faq_categories.html'))
+    assert results['lxml'] == results['html.parser']
+    assert [category.name for category in results['html.parser']] == [
+        'Getting Started', 'Rules & Objectives', 'Payouts']
+
+
+def test_faq_articles_are_the_same_for_every_backend():
+    results = parse_with_each_backend(parse_articles, read_fixture('faq_articles.html'))
+    assert results['lxml'] == results['html.parser']
+    articles = results['html.parser']
+    assert [article.name for article in articles] == [
+        'What is the daily drawdown?', 'Can I trade the news?', 'Can I hold trades over the weekend?']
+    assert articles[1].description == 'Yes — except on Standard accounts.'
+    assert articles[2].description == ''
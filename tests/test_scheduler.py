@@ -0,0 +1,20 @@
+import asyncio
+
+from tft.http import FetchError
+from tft.scheduler import PollScheduler
+
+
+def test_fetch_errors_count_as_failures():
+    async def outage():
+        raise FetchError('https://scheduler.test/', 'gave up after 4 attempts')
+
+    async def poll_once():
+        scheduler = PollScheduler(spacing=0)
+        source = scheduler.register('outage', outage, interval=60)
+        await scheduler._poll(source)
+        return source
+
+    source = asyncio.run(poll_once())
+    assert source.failures == 1
+    assert source.last_state == 'failed'
+    assert source.interval == 120
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from functools import partial
+from typing import Callable, Awaitable, Iterable, List, Optional, TypeVar, Union, Dict, Hashable, Tuple
+from weakref import WeakSet
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+R = TypeVar('R')
+
+
+async def fan_out(
+        func: Callable[[T], Awaitable[R]],
+        items: Iterable[T],
+        limit: int = 10,
+        timeout: Optional[float] = None
+) -> List[Union[R, BaseException]]:
+    """Runs func for every item with at most ``limit`` calls in flight.
+
+    Each call is cancelled after ``timeout`` seconds so one slow item cannot stall the rest.
+    Results come back in the same order as items; failed calls are returned as their exception
+    instead of being raised.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(item: T) -> R:
+        async with semaphore:
+            if timeout is None:
+                return await func(item)
+            return await asyncio.wait_for(func(item), timeout)
+
+    return await asyncio.gather(*(run(item) for item in items), return_exceptions=True)
+
+
+class SingleFlight:
+    """Lets concurrent callers asking for the same key share one in-flight call.
+
+    The first caller starts the call, everyone arriving before it finishes awaits the same result (or exception).
+    Cancelling one caller does not cancel the shared call for the others, but once every caller has been
+    cancelled the shared call is cancelled too, so work nobody waits for any more does not keep running.
+    ``calls`` counts the calls that were actually made and ``coalesced`` the callers that joined one instead.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.calls = 0
+        self.coalesced = 0
+        self._in_flight: Dict[Hashable, asyncio.Future] = {}
+        # in-flight call -> callers still waiting for it
+        self._waiters: Dict[asyncio.Future, int] = {}
+        _flights.add(self)
+
+    def _forget(self, key: Hashable, future: asyncio.Future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
+        if not future.cancelled():
+            # Mark the exception as retrieved in case every caller was cancelled
+            future.exception()
+
+    async def do(self, key: Hashable, func: Callable[[], Awaitable[R]]) -> R:
+        future = self._in_flight.get(key)
+        if future is None:
+            self.calls += 1
+            future = asyncio.ensure_future(func())
+            self._in_flight[key] = future
+            future.add_done_callback(partial(self._forget, key))
+        else:
+            self.coalesced += 1
+            log.debug(f"{self.name}: joined the in-flight call for {key}")
+        self._waiters[future] = self._waiters.get(future, 0) + 1
+        try:
+            return await asyncio.shield(future)
+        finally:
+            self._waiters[future] -= 1
+            if not self._waiters[future]:
+                del self._waiters[future]
+                if not future.done():
+                    # The last caller was cancelled
+                    future.cancel()
+
+
+_flights: 'WeakSet[SingleFlight]' = WeakSet()
+
+
+def single_flight_stats() -> Dict[str, Tuple[int, int]]:
+    """Calls made and calls coalesced for every live SingleFlight, by name"""
+    stats: Dict[str, Tuple[int, int]] = {}
+    for flight in _flights:
+        calls, coalesced = stats.get(flight.name, (0, 0))
+        stats[flight.name] = (calls + flight.calls, coalesced + flight.coalesced)
+    return stats
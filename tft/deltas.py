@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from atomicwrites import atomic_write
+
+from tft.schema import LeaderboardEntry, CompetitionEntry, parse_number
+
+log = logging.getLogger(__name__)
+
+# nickname -> (rank, roi)
+Snapshot = Dict[str, Tuple[int, Optional[float]]]
+
+
+class Movement(NamedTuple):
+    name: str
+    rank: int
+    roi: Optional[float]
+    previous_rank: Optional[int] = None
+    previous_roi: Optional[float] = None
+
+    @property
+    def is_new(self) -> bool:
+        return self.previous_rank is None
+
+    @property
+    def rank_change(self) -> int:
+        """Places gained since the previous poll. Negative when the trader dropped"""
+        if self.previous_rank is None:
+            return 0
+        return self.previous_rank - self.rank
+
+    @property
+    def changed(self) -> bool:
+        return self.is_new or self.rank_change != 0 or self.roi != self.previous_roi
+
+    @property
+    def arrow(self) -> str:
+        if self.is_new:
+            return "NEW"
+        if self.rank_change > 0:
+            return f"▲{self.rank_change}"
+        if self.rank_change < 0:
+            return f"▼{-self.rank_change}"
+        return ""
+
+
+def take_snapshot(entries: Sequence[Union[LeaderboardEntry, CompetitionEntry]]) -> Snapshot:
+    return {entry.name: (entry.rank, parse_number(entry.roi)) for entry in entries}
+
+
+def compute_movements(
+        previous: Snapshot,
+        entries: Sequence[Union[LeaderboardEntry, CompetitionEntry]]
+) -> List[Movement]:
+    """Compares a fresh poll against the previous snapshot with one dictionary lookup per entry"""
+    movements = []
+    for entry in entries:
+        previous_rank, previous_roi = previous.get(entry.name, (None, None))
+        movements.append(Movement(
+            name=entry.name,
+            rank=entry.rank,
+            roi=parse_number(entry.roi),
+            previous_rank=previous_rank,
+            previous_roi=previous_roi
+        ))
+    return movements
+
+
+class SnapshotFile:
+    """Persists the last snapshot of a board so movements survive a restart.
+    Only the most recent snapshot is kept; a snapshot of a different board (a new competition) is ignored on load."""
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self, board: str) -> Snapshot:
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        if data.get('board') != board:
+            return {}
+        return {name: (rank, roi) for name, (rank, roi) in data.get('entries', {}).items()}
+
+    def save(self, board: str, snapshot: Snapshot):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with atomic_write(self.path, overwrite=True, encoding='utf-8') as f:
+            json.dump({'board': board, 'entries': snapshot}, f)
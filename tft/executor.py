@@ -0,0 +1,56 @@
+import asyncio
+import logging
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from functools import partial
+from typing import Optional, Callable, TypeVar, Tuple, Any
+
+from tft.metrics import BLOCKING_SECONDS
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+EXECUTOR_KINDS = ('thread', 'process')
+_executor: Optional[Executor] = None
+
+
+def configure_executor(
+        kind: str = 'thread',
+        workers: Optional[int] = None,
+        initializer: Optional[Callable[..., Any]] = None,
+        initargs: Tuple[Any, ...] = ()
+) -> Executor:
+    """Creates the pool that CPU bound parsing and rendering runs on.
+    A process pool sidesteps the GIL but can only exchange picklable plain data with the event loop.
+    The initializer runs in every worker, which is how module level settings reach a process pool."""
+    global _executor
+    if kind not in EXECUTOR_KINDS:
+        raise ValueError(f"Unknown executor kind {kind}. Choose one of {', '.join(EXECUTOR_KINDS)}")
+    shutdown_executor()
+    if kind == 'process':
+        _executor = ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    else:
+        _executor = ThreadPoolExecutor(
+            max_workers=workers,
+            thread_name_prefix='tft-worker',
+            initializer=initializer,
+            initargs=initargs
+        )
+    log.info(f"Running CPU bound work on a {kind} pool with {workers or 'default'} workers")
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
+
+
+async def run_blocking(func: Callable[..., T], *args: Any) -> T:
+    """Runs func on the configured pool so it never blocks the event loop.
+    Falls back to the loop's default thread pool when no pool was configured."""
+    loop = asyncio.get_running_loop()
+    # Measured from the event loop, so time spent waiting for a free worker is included
+    with BLOCKING_SECONDS.time(function=func.__name__):
+        return await loop.run_in_executor(_executor, partial(func, *args))
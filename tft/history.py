@@ -0,0 +1,202 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union, Iterable, Dict
+
+from tft.schema import LeaderboardEntry, CompetitionEntry, parse_number
+
+log = logging.getLogger(__name__)
+
+DAY = 60 * 60 * 24
+
+# (age in seconds, bucket in seconds): snapshots older than age are thinned out to one per bucket.
+# Everything younger than the first tier is kept at full poll resolution.
+DEFAULT_RETENTION_TIERS: Tuple[Tuple[int, int], ...] = (
+    (DAY, 60 * 60),
+    (7 * DAY, DAY),
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS traders (
+    id INTEGER PRIMARY KEY,
+    nickname TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    id INTEGER PRIMARY KEY,
+    board TEXT NOT NULL,
+    taken_at INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS snapshots_board_taken_at ON snapshots (board, taken_at);
+CREATE TABLE IF NOT EXISTS entries (
+    snapshot_id INTEGER NOT NULL,
+    trader_id INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    roi REAL,
+    profit REAL,
+    back REAL,
+    prize REAL,
+    PRIMARY KEY (snapshot_id, rank)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_trader ON entries (trader_id, snapshot_id);
+"""
+
+
+class HistoryPoint(NamedTuple):
+    taken_at: datetime
+    rank: int
+    roi: Optional[float]
+    profit: Optional[float]
+    back: Optional[float]
+    prize: Optional[float]
+
+
+class HistoryStore:
+    """Append-only history of every board the bot polls.
+
+    Nicknames are interned into the traders table so each snapshot row is a handful of integers and floats.
+    Older snapshots are thinned out by retention tier: full resolution for the first day, one per hour for a week
+    and one per day after that. Lookups by trader and by time range are served by indexes.
+
+    The methods block on SQLite, so call them with asyncio.to_thread from the event loop.
+    """
+    def __init__(
+            self,
+            path: str,
+            retention_tiers: Sequence[Tuple[int, int]] = DEFAULT_RETENTION_TIERS,
+            compact_every: int = 60 * 60
+    ):
+        self.path = path
+        self.retention_tiers = retention_tiers
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._trader_ids: Dict[str, int] = {}
+        self._last_compacted = 0.0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(SCHEMA)
+        self._connection.commit()
+
+    def _intern(self, nicknames: Iterable[str]) -> Dict[str, int]:
+        missing = [name for name in set(nicknames) if name not in self._trader_ids]
+        self._connection.executemany("INSERT OR IGNORE INTO traders (nickname) VALUES (?)", ((n,) for n in missing))
+        # Stay well under SQLite's limit on bound parameters
+        for start in range(0, len(missing), 500):
+            chunk = missing[start:start + 500]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._connection.execute(f"SELECT nickname, id FROM traders WHERE nickname IN ({placeholders})", chunk)
+            self._trader_ids.update(rows)
+        return self._trader_ids
+
+    def _insert_snapshot(
+            self,
+            board: str,
+            entries: Sequence[Union[LeaderboardEntry, CompetitionEntry]],
+            taken_at: datetime
+    ) -> int:
+        trader_ids = self._intern(entry.name for entry in entries)
+        cursor = self._connection.execute(
+            "INSERT INTO snapshots (board, taken_at) VALUES (?, ?)",
+            (board, int(taken_at.timestamp()))
+        )
+        snapshot_id = cursor.lastrowid
+        # Keyed by rank, so traders that share a nickname each keep their row
+        self._connection.executemany(
+            "INSERT INTO entries (snapshot_id, trader_id, rank, roi, profit, back, prize) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                (
+                    snapshot_id,
+                    trader_ids[entry.name],
+                    entry.rank,
+                    parse_number(entry.roi),
+                    parse_number(getattr(entry, 'profit', None)),
+                    parse_number(getattr(entry, 'back', None)),
+                    parse_number(getattr(entry, 'prize', None)),
+                )
+                for entry in entries
+            ]
+        )
+        return snapshot_id
+
+    def record(
+            self,
+            board: str,
+            entries: Sequence[Union[LeaderboardEntry, CompetitionEntry]],
+            taken_at: Optional[datetime] = None
+    ) -> int:
+        """Stores one snapshot of a board and returns its id"""
+        taken_at = taken_at or datetime.now(timezone.utc)
+        with self._lock:
+            try:
+                with self._connection:
+                    snapshot_id = self._insert_snapshot(board, entries, taken_at)
+            except sqlite3.Error:
+                # Trader ids handed out inside the rolled back transaction are not valid any more
+                self._trader_ids.clear()
+                raise
+        log.debug(f"Recorded {len(entries)} {board} entries as snapshot {snapshot_id}")
+        if time.monotonic() - self._last_compacted >= self.compact_every:
+            self.compact()
+        return snapshot_id
+
+    def compact(self, now: Optional[datetime] = None) -> int:
+        """Thins out old snapshots according to the retention tiers. Returns how many snapshots were removed"""
+        now = int((now or datetime.now(timezone.utc)).timestamp())
+        removed = 0
+        with self._lock, self._connection:
+            for age, bucket in self.retention_tiers:
+                cutoff = now - age
+                doomed = [
+                    row[0] for row in self._connection.execute(
+                        "SELECT id FROM snapshots WHERE taken_at < ? AND id NOT IN ("
+                        "SELECT MIN(id) FROM snapshots WHERE taken_at < ? GROUP BY board, taken_at / ?)",
+                        (cutoff, cutoff, bucket)
+                    )
+                ]
+                self._connection.executemany("DELETE FROM entries WHERE snapshot_id = ?", ((i,) for i in doomed))
+                self._connection.executemany("DELETE FROM snapshots WHERE id = ?", ((i,) for i in doomed))
+                removed += len(doomed)
+        self._last_compacted = time.monotonic()
+        if removed:
+            log.info(f"Compacted {removed} old snapshots from {self.path}")
+        return removed
+
+    def trader_history(
+            self,
+            nickname: str,
+            board: str,
+            since: Optional[datetime] = None,
+            until: Optional[datetime] = None
+    ) -> List[HistoryPoint]:
+        """Every recorded position of a trader on a board, oldest first"""
+        since_ts = int(since.timestamp()) if since else 0
+        until_ts = int(until.timestamp()) if until else 2 ** 62
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT s.taken_at, e.rank, e.roi, e.profit, e.back, e.prize "
+                "FROM traders t "
+                "JOIN entries e ON e.trader_id = t.id "
+                "JOIN snapshots s ON s.id = e.snapshot_id "
+                "WHERE t.nickname = ? AND s.board = ? AND s.taken_at BETWEEN ? AND ? "
+                "ORDER BY s.taken_at",
+                (nickname, board, since_ts, until_ts)
+            ).fetchall()
+        return [HistoryPoint(datetime.fromtimestamp(row[0], timezone.utc), *row[1:]) for row in rows]
+
+    def snapshots_between(self, board: str, since: datetime, until: datetime) -> List[Tuple[int, datetime]]:
+        """Ids and times of the snapshots taken of a board in a time range, oldest first"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT id, taken_at FROM snapshots WHERE board = ? AND taken_at BETWEEN ? AND ? ORDER BY taken_at",
+                (board, int(since.timestamp()), int(until.timestamp()))
+            ).fetchall()
+        return [(snapshot_id, datetime.fromtimestamp(taken_at, timezone.utc)) for snapshot_id, taken_at in rows]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,327 @@
+import asyncio
+import hashlib
+import logging
+import random
+import time
+from functools import partial
+from typing import Optional, NamedTuple, Dict, Any, Hashable, Callable, Awaitable, TypeVar
+
+import aiohttp
+from yarl import URL
+
+from tft.concurrency import SingleFlight
+from tft.metrics import FETCH_SECONDS, FETCH_RETRIES, NOT_MODIFIED, RATE_LIMITED
+
+log = logging.getLogger(__name__)
+
+T = TypeVar('T')
+
+# Statuses worth trying again. Anything else in the 4xx range will not get better by retrying.
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+def create_session(
+        limit: int = 100,
+        limit_per_host: int = 10,
+        dns_ttl: int = 300,
+        keepalive_timeout: float = 60,
+        total_timeout: float = 30,
+        connect_timeout: float = 10,
+) -> aiohttp.ClientSession:
+    """Creates the bot-wide HTTP client.
+
+    A single session is shared by every cog and service function so that polls reuse
+    warm keep-alive connections instead of paying a DNS lookup and TCP/TLS handshake on each fetch.
+    This must be called from inside a running event loop and closed when the bot shuts down.
+    """
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        ttl_dns_cache=dns_ttl,
+        use_dns_cache=True,
+        keepalive_timeout=keepalive_timeout,
+    )
+    timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout)
+    log.debug(f"Creating HTTP session (limit={limit}, per host={limit_per_host}, dns ttl={dns_ttl}s)")
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+class FetchError(Exception):
+    """Raised when a URL could not be fetched after every attempt the retry policy allows"""
+    def __init__(self, url: str, message: str):
+        super(FetchError, self).__init__(f"{url}: {message}")
+        self.url = url
+
+
+class CircuitOpenError(FetchError):
+    """Raised without contacting the host while its circuit breaker is open"""
+
+
+class RetryPolicy(NamedTuple):
+    max_attempts: int = 4
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+
+    def backoff(self, attempt: int) -> float:
+        """Exponential backoff with full jitter for the given (1 based) attempt"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+
+DEFAULT_RETRY_POLICY = RetryPolicy()
+
+
+class CircuitBreaker:
+    """Tracks consecutive failures for a single host.
+
+    After ``failure_threshold`` failures in a row the circuit opens and callers fail fast for ``reset_timeout``
+    seconds. Once that has passed a single trial request is let through: success closes the circuit again,
+    failure re-opens it for another ``reset_timeout``.
+    """
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    @property
+    def retry_after(self) -> float:
+        if self.opened_at is None:
+            return 0.0
+        return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self._trial_in_flight:
+            self._trial_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def release(self):
+        """Ends a trial request without counting it either way, for replies that say nothing about the host's health"""
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self._trial_in_flight or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial_in_flight = False
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_breaker(url: str) -> CircuitBreaker:
+    """Returns the circuit breaker shared by every request to the host of url"""
+    host = URL(url).host or url
+    if host not in _breakers:
+        _breakers[host] = CircuitBreaker()
+    return _breakers[host]
+
+
+def url_label(url: str) -> str:
+    """The URL without its query string, to keep the number of metric series down"""
+    return str(URL(url).with_query(None))
+
+
+def _is_retryable(error: Exception) -> bool:
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRYABLE_STATUSES
+    return isinstance(error, (aiohttp.ClientError, asyncio.TimeoutError))
+
+
+async def call_with_policy(
+        url: str,
+        func: Callable[[], Awaitable[T]],
+        policy: RetryPolicy = DEFAULT_RETRY_POLICY
+) -> T:
+    """Calls func, retrying transient network failures with exponential backoff.
+
+    Every attempt goes through the circuit breaker of the host so a site that is down is not hammered
+    by every cog. Raises CircuitOpenError while the breaker is open and FetchError once the attempts are used up.
+    Errors that are not transient (a 404, a parse error) are not retried and raised as FetchError right away.
+    """
+    with FETCH_SECONDS.time(url=url_label(url)):
+        return await _call_with_policy(url, func, policy)
+
+
+async def _call_with_policy(url: str, func: Callable[[], Awaitable[T]], policy: RetryPolicy) -> T:
+    breaker = get_breaker(url)
+    for attempt in range(1, policy.max_attempts + 1):
+        if not breaker.allow():
+            raise CircuitOpenError(url, f"circuit open, retry in {breaker.retry_after:.0f}s")
+        try:
+            result = await func()
+        except Exception as e:
+            if not _is_retryable(e):
+                # The host answered, so this says nothing about whether it is up
+                breaker.release()
+                if isinstance(e, FetchError):
+                    raise
+                raise FetchError(url, f"failed with {e!r}") from e
+            breaker.record_failure()
+            if isinstance(e, aiohttp.ClientResponseError) and e.status == 429:
+                RATE_LIMITED.inc(source=URL(url).host or url)
+            if attempt == policy.max_attempts:
+                raise FetchError(url, f"gave up after {attempt} attempts ({e!r})") from e
+            delay = policy.backoff(attempt)
+            FETCH_RETRIES.inc(url=url_label(url))
+            log.warning(f"Fetching {url} failed ({e!r}). Attempt {attempt}/{policy.max_attempts}, retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
+        except BaseException:
+            # Cancelled mid request. Without this a half-open breaker would wait forever for the trial to end
+            breaker.release()
+            raise
+        else:
+            breaker.record_success()
+            return result
+
+
+class FetchResult(NamedTuple):
+    text: str
+    changed: bool
+
+
+class StreamResult(NamedTuple):
+    value: Any
+    changed: bool
+
+
+class _CacheEntry(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    digest: str
+    text: str
+
+
+class _StreamEntry(NamedTuple):
+    etag: Optional[str]
+    last_modified: Optional[str]
+    value: Any
+
+
+class ConditionalFetcher:
+    """Fetches pages while remembering the validators of the last response for each URL.
+
+    Requests are sent with If-None-Match / If-Modified-Since when the server handed out an
+    ETag or Last-Modified header. A 304 reply, or a 200 reply whose body hashes to the same digest
+    as last time (for servers without validators), comes back as ``changed=False`` with the last known body
+    so callers can skip their parse and publish steps.
+    Concurrent fetches of the same request share a single round trip.
+    """
+    def __init__(self, session: aiohttp.ClientSession, policy: RetryPolicy = DEFAULT_RETRY_POLICY):
+        self.session = session
+        self.policy = policy
+        self._cache: Dict[Hashable, _CacheEntry] = {}
+        self._streams: Dict[str, _StreamEntry] = {}
+        self._flight = SingleFlight('fetch')
+
+    @staticmethod
+    def _key(method: str, url: str, data: Optional[Dict[str, Any]]) -> Hashable:
+        body = tuple(sorted(data.items())) if data else None
+        return method.upper(), url, body
+
+    async def fetch(
+            self,
+            url: str,
+            method: str = 'GET',
+            data: Optional[Dict[str, Any]] = None,
+            headers: Optional[Dict[str, str]] = None
+    ) -> FetchResult:
+        key = self._key(method, url, data)
+        return await self._flight.do(key, partial(self._fetch, key, url, method, data, headers))
+
+    async def _fetch(
+            self,
+            key: Hashable,
+            url: str,
+            method: str,
+            data: Optional[Dict[str, Any]],
+            headers: Optional[Dict[str, str]]
+    ) -> FetchResult:
+        cached = self._cache.get(key)
+        request_headers = dict(headers or {})
+        if cached is not None:
+            if cached.etag:
+                request_headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                request_headers['If-Modified-Since'] = cached.last_modified
+
+        async def request():
+            async with self.session.request(method, url, data=data, headers=request_headers) as response:
+                if response.status == 304 and cached is not None:
+                    return None
+                response.raise_for_status()
+                body = await response.read()
+                return body, response.get_encoding(), response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+        reply = await call_with_policy(url, request, self.policy)
+        if reply is None:
+            NOT_MODIFIED.inc(url=url_label(url))
+            log.debug(f"{url} not modified")
+            return FetchResult(text=cached.text, changed=False)
+        body, encoding, etag, last_modified = reply
+        text = body.decode(encoding, errors='replace')
+        digest = hashlib.sha256(body).hexdigest()
+        self._cache[key] = _CacheEntry(etag=etag, last_modified=last_modified, digest=digest, text=text)
+        changed = cached is None or cached.digest != digest
+        if not changed:
+            NOT_MODIFIED.inc(url=url_label(url))
+            log.debug(f"{url} returned an identical body")
+        return FetchResult(text=text, changed=changed)
+
+    async def stream(
+            self,
+            url: str,
+            consume: Callable[[aiohttp.ClientResponse], Awaitable[T]],
+            headers: Optional[Dict[str, str]] = None
+    ) -> StreamResult:
+        """GETs url and hands the open response to consume, which may stop reading the body early.
+
+        The request carries the validators of the last response the same way fetch does, and a 304 comes back
+        as ``changed=False`` with the value consume returned last time. As the body may not be read to the end
+        there is no digest to compare; servers without validators get the value compared with the last one instead.
+        """
+        cached = self._streams.get(url)
+        request_headers = dict(headers or {})
+        if cached is not None:
+            if cached.etag:
+                request_headers['If-None-Match'] = cached.etag
+            if cached.last_modified:
+                request_headers['If-Modified-Since'] = cached.last_modified
+
+        async def request():
+            async with self.session.get(url, headers=request_headers) as response:
+                if response.status == 304 and cached is not None:
+                    return None
+                response.raise_for_status()
+                value = await consume(response)
+                return value, response.headers.get('ETag'), response.headers.get('Last-Modified')
+
+        reply = await call_with_policy(url, request, self.policy)
+        if reply is None:
+            NOT_MODIFIED.inc(url=url_label(url))
+            log.debug(f"{url} not modified")
+            return StreamResult(value=cached.value, changed=False)
+        value, etag, last_modified = reply
+        self._streams[url] = _StreamEntry(etag=etag, last_modified=last_modified, value=value)
+        changed = cached is None or cached.value != value
+        if not changed:
+            NOT_MODIFIED.inc(url=url_label(url))
+            log.debug(f"{url} returned the same values")
+        return StreamResult(value=value, changed=changed)
@@ -0,0 +1,119 @@
+import bisect
+import difflib
+import heapq
+from collections import defaultdict, Counter
+from typing import Dict, List, Set, Iterable, NamedTuple, Optional, Union
+
+from tft.schema import CompetitionEntry, EntryBatch
+
+
+class IndexUpdate(NamedTuple):
+    added: int
+    updated: int
+    removed: int
+
+
+def _trigrams(key: str) -> Set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class TraderIndex:
+    """In-memory lookup over every contestant of a competition.
+
+    Nicknames are kept in a sorted array for exact and prefix lookups with bisect, and in a trigram
+    inverted index for fuzzy matches. update() applies the difference between two polls, so only traders that
+    joined or left the field touch the indexes; everyone else just gets their position updated.
+    The field itself is held as an EntryBatch and entries are only built for the matches of a lookup.
+    """
+    def __init__(self):
+        self.batch = EntryBatch([])
+        # lower cased nickname -> positions in the batch. Nicknames can differ only by case, so one key can hold several
+        self._entries: Dict[str, List[int]] = {}
+        self._keys: List[str] = []
+        self._trigrams: Dict[str, Set[str]] = defaultdict(set)
+
+    def __len__(self) -> int:
+        return len(self.batch)
+
+    def update(self, entries: Union[EntryBatch, Iterable[CompetitionEntry]]) -> IndexUpdate:
+        batch = entries if isinstance(entries, EntryBatch) else EntryBatch(entries)
+        fresh: Dict[str, List[int]] = defaultdict(list)
+        for position, name in enumerate(batch.names):
+            fresh[name.lower()].append(position)
+        removed = [key for key in self._entries.keys() if key not in fresh]
+        added = [key for key in fresh.keys() if key not in self._entries]
+
+        for key in removed:
+            for gram in _trigrams(key):
+                keys = self._trigrams[gram]
+                keys.discard(key)
+                if not keys:
+                    del self._trigrams[gram]
+        for key in added:
+            for gram in _trigrams(key):
+                self._trigrams[gram].add(key)
+
+        if len(added) + len(removed) > len(self._keys) // 8:
+            # Large change, a full sort is cheaper than many list insertions
+            self._keys = sorted(fresh.keys())
+        else:
+            for key in removed:
+                del self._keys[bisect.bisect_left(self._keys, key)]
+            for key in added:
+                bisect.insort(self._keys, key)
+
+        updated = len(fresh) - len(added)
+        self._entries = dict(fresh)
+        self.batch = batch
+        return IndexUpdate(added=len(added), updated=updated, removed=len(removed))
+
+    def clear(self):
+        self.batch = EntryBatch([])
+        self._entries = {}
+        self._keys = []
+        self._trigrams = defaultdict(set)
+
+    def _rank(self, position: int) -> int:
+        return self.batch.ranks[position]
+
+    def get_all(self, nickname: str) -> List[CompetitionEntry]:
+        """Every contestant whose nickname matches regardless of case, best ranked first"""
+        positions = self._entries.get(nickname.lower().strip(), [])
+        return [self.batch[position] for position in sorted(positions, key=self._rank)]
+
+    def get(self, nickname: str) -> Optional[CompetitionEntry]:
+        matches = self.get_all(nickname)
+        return matches[0] if matches else None
+
+    def prefix(self, query: str, limit: int = 10) -> List[CompetitionEntry]:
+        """The best ranked contestants whose nickname starts with query"""
+        query = query.lower().strip()
+        start = bisect.bisect_left(self._keys, query)
+        # Every key starting with query sorts before query followed by the highest code point
+        end = bisect.bisect_left(self._keys, query + chr(0x10ffff), lo=start)
+        positions = [position for key in self._keys[start:end] for position in self._entries[key]]
+        return [self.batch[position] for position in heapq.nsmallest(limit, positions, key=self._rank)]
+
+    def fuzzy(self, query: str, limit: int = 5, cutoff: float = 0.6) -> List[CompetitionEntry]:
+        query = query.lower().strip()
+        shared = Counter()
+        for gram in _trigrams(query):
+            shared.update(self._trigrams.get(gram, ()))
+        # Only score the handful of nicknames that share the most trigrams with the query
+        candidates = [key for key, _ in shared.most_common(limit * 10)]
+        scored = []
+        for key in candidates:
+            ratio = difflib.SequenceMatcher(None, query, key).ratio()
+            if ratio >= cutoff:
+                scored.append((ratio, key))
+        positions = [(ratio, position) for ratio, key in scored for position in self._entries[key]]
+        positions.sort(key=lambda item: (-item[0], self._rank(item[1])))
+        return [self.batch[position] for _, position in positions[:limit]]
+
+    def lookup(self, query: str, limit: int = 5) -> List[CompetitionEntry]:
+        """Exact match first, then nicknames starting with the query, then the closest fuzzy matches"""
+        exact = self.get_all(query)
+        if exact:
+            return exact[:limit]
+        return self.prefix(query, limit) or self.fuzzy(query, limit)
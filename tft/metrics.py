@@ -0,0 +1,215 @@
+import bisect
+import logging
+import math
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+import aiohttp
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+LabelValues = Tuple[str, ...]
+
+# Seconds. Fetches and Discord edits take tens of milliseconds to tens of seconds with retries.
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _key(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super(Counter, self).__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> Iterator[str]:
+        for key, value in sorted(self._values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Gauge(Metric):
+    """A value that goes up and down. Values can be set directly or read from a callback at scrape time"""
+    kind = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._callbacks: Dict[LabelValues, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: str):
+        self._values[self._key(labels)] = value
+
+    def track(self, func: Callable[[], float], **labels: str):
+        """Reads the value from func whenever the metrics are scraped"""
+        self._callbacks[self._key(labels)] = func
+
+    def samples(self) -> Iterator[str]:
+        values = dict(self._values)
+        for key, func in self._callbacks.items():
+            try:
+                values[key] = func()
+            except Exception as e:
+                log.debug(f"Could not read {self.name}{key}: {e!r}")
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(
+            self,
+            name: str,
+            documentation: str,
+            labelnames: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS
+    ):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (count per bucket, sum, count)
+        self._series: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterator[str]:
+        for key, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        """Every metric in the Prometheus text exposition format"""
+        return '\n'.join(metric.render() for metric in self._metrics.values()) + '\n'
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS: Histogram = REGISTRY.register(Histogram(
+    'tft_fetch_seconds', "Time to fetch a URL, retries included", ('url',)))
+FETCH_RETRIES: Counter = REGISTRY.register(Counter(
+    'tft_fetch_retries_total', "Fetch attempts that failed and were retried", ('url',)))
+NOT_MODIFIED: Counter = REGISTRY.register(Counter(
+    'tft_fetch_not_modified_total', "Fetches answered with a 304 or an identical body", ('url',)))
+BLOCKING_SECONDS: Histogram = REGISTRY.register(Histogram(
+    'tft_blocking_seconds', "Time spent in parse and render functions run off the event loop", ('function',)))
+RENDER_SECONDS: Histogram = REGISTRY.register(Histogram(
+    'tft_render_seconds', "Time to render a board embed that was not in the render cache", ('board',)))
+EDIT_SECONDS: Histogram = REGISTRY.register(Histogram(
+    'tft_discord_edit_seconds', "Latency of editing a published board message", ('board',)))
+EDITS_SKIPPED: Counter = REGISTRY.register(Counter(
+    'tft_discord_edits_skipped_total', "Message edits skipped because the message already showed the content",
+    ('board',)))
+RATE_LIMITED: Counter = REGISTRY.register(Counter(
+    'tft_rate_limited_total', "Requests that hit a rate limit", ('source',)))
+TRACKED_GUILDS: Gauge = REGISTRY.register(Gauge(
+    'tft_tracked_guilds', "Guilds with a published board message", ('board',)))
+CONFIG_KEYS: Gauge = REGISTRY.register(Gauge(
+    'tft_config_keys', "Keys in each settings section", ('section',)))
+CACHE_HIT_RATIO: Gauge = REGISTRY.register(Gauge(
+    'tft_cache_hit_ratio', "Share of lookups answered from a cache", ('cache',)))
+
+
+def hit_ratio(hits: int, misses: int) -> float:
+    total = hits + misses
+    return hits / total if total else 0.0
+
+
+def discord_rate_limit_trace() -> aiohttp.TraceConfig:
+    """discord.py retries 429s on its own, so they never reach the bot. Pass this as the http_trace of the
+    bot to count every 429 Discord answers with"""
+    async def on_request_end(session, context, params: aiohttp.TraceRequestEndParams):
+        if params.response.status == 429:
+            RATE_LIMITED.inc(source='discord')
+
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_request_end)
+    return trace
+
+
+async def start_metrics_server(host: str = '127.0.0.1', port: int = 9108) -> web.AppRunner:
+    """Serves REGISTRY on http://host:port/metrics. Returns the runner to clean up on shutdown"""
+    async def metrics(request: web.Request) -> web.Response:
+        return web.Response(
+            body=REGISTRY.render().encode('utf-8'),
+            headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+        )
+
+    app = web.Application()
+    app.router.add_get('/metrics', metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    log.info(f"Serving metrics on http://{host}:{port}/metrics")
+    return runner
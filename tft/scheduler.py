@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Callable, Awaitable, Optional, Dict, List
+
+from tft.http import get_breaker, FetchError
+
+log = logging.getLogger(__name__)
+
+
+class PollSource:
+    """One periodically polled data source and the bookkeeping the scheduler adapts its interval from"""
+    def __init__(
+            self,
+            name: str,
+            callback: Callable[[], Awaitable[bool]],
+            interval: float,
+            min_interval: float,
+            max_interval: float,
+            url: Optional[str] = None,
+            urgent: Optional[Callable[[], bool]] = None
+    ):
+        self.name = name
+        self.callback = callback
+        self.base_interval = interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.url = url
+        self.urgent = urgent
+        self.interval = interval
+        self.next_run = time.monotonic()
+        self.running = False
+        self.runs = 0
+        self.changes = 0
+        self.failures = 0
+        self.unchanged_streak = 0
+        self.last_duration: Optional[float] = None
+        self.last_state = 'pending'
+
+    @property
+    def backing_off(self) -> float:
+        """Seconds until the circuit breaker of the source's host lets requests through again"""
+        if self.url is None:
+            return 0.0
+        breaker = get_breaker(self.url)
+        return breaker.retry_after if breaker.state == 'open' else 0.0
+
+    def adapt(self, changed: Optional[bool]):
+        """Works out the next interval from the outcome of a poll.
+        Changes halve the interval, every unchanged poll stretches it by half and a failure doubles it.
+        An urgent source never waits longer than its minimum interval, unless its host is backing off."""
+        if changed is None:
+            self.failures += 1
+            self.last_state = 'failed'
+            self.interval = min(self.max_interval, self.interval * 2)
+        elif changed:
+            self.changes += 1
+            self.unchanged_streak = 0
+            self.last_state = 'changed'
+            self.interval = max(self.min_interval, self.interval / 2)
+        else:
+            self.unchanged_streak += 1
+            self.last_state = 'unchanged'
+            self.interval = min(self.max_interval, self.interval * 1.5)
+        if self.urgent is not None and self.urgent():
+            self.interval = self.min_interval
+        delay = max(self.interval, self.backing_off)
+        # A little jitter keeps sources that settled on the same interval from firing together
+        self.next_run = time.monotonic() + delay * random.uniform(0.9, 1.1)
+
+
+class PollScheduler:
+    """Runs every registered poll source from a single task.
+
+    Each source gets its own interval between min_interval and max_interval that follows how often its data
+    actually changes, and backs off while the circuit breaker of its host is open. Two sources never start
+    within ``spacing`` seconds of each other, so their requests do not burst. A source is not started again
+    while its previous poll is still running.
+    """
+    def __init__(self, spacing: float = 5.0):
+        self.spacing = spacing
+        self.sources: Dict[str, PollSource] = {}
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: Dict[str, asyncio.Task] = {}
+        self._last_started = 0.0
+
+    def register(
+            self,
+            name: str,
+            callback: Callable[[], Awaitable[bool]],
+            interval: float,
+            min_interval: Optional[float] = None,
+            max_interval: Optional[float] = None,
+            url: Optional[str] = None,
+            urgent: Optional[Callable[[], bool]] = None
+    ) -> PollSource:
+        """Adds a source that is polled right away and then adaptively around interval seconds.
+        The callback returns True when its data changed and False when it did not; raising counts as a failure"""
+        source = PollSource(
+            name,
+            callback,
+            interval,
+            min_interval=min_interval or interval / 4,
+            max_interval=max_interval or interval * 3,
+            url=url,
+            urgent=urgent
+        )
+        self.sources[name] = source
+        self._wakeup.set()
+        log.info(f"Registered poll source {name} every {interval:.0f}s")
+        return source
+
+    def unregister(self, name: str):
+        self.sources.pop(name, None)
+        task = self._running.pop(name, None)
+        if task is not None:
+            task.cancel()
+        self._wakeup.set()
+
+    def poll_now(self, name: str):
+        """Moves a source to the front of the queue"""
+        self.sources[name].next_run = time.monotonic()
+        self._wakeup.set()
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        tasks = list(self._running.values())
+        if self._task is not None:
+            tasks.append(self._task)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._running.clear()
+        self._task = None
+
+    def _next_due(self) -> Optional[PollSource]:
+        idle = [source for source in self.sources.values() if not source.running]
+        return min(idle, key=lambda source: source.next_run, default=None)
+
+    async def _run(self):
+        while True:
+            self._wakeup.clear()
+            source = self._next_due()
+            if source is None:
+                await self._wakeup.wait()
+                continue
+            start_at = max(source.next_run, self._last_started + self.spacing)
+            delay = start_at - time.monotonic()
+            if delay > 0:
+                try:
+                    # Registrations and finished polls wake us early, the queue is looked at again then
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                    continue
+                except asyncio.TimeoutError:
+                    pass
+            self._last_started = time.monotonic()
+            source.running = True
+            self._running[source.name] = asyncio.ensure_future(self._poll(source))
+
+    async def _poll(self, source: PollSource):
+        started = time.perf_counter()
+        changed: Optional[bool]
+        try:
+            changed = bool(await source.callback())
+        except asyncio.CancelledError:
+            raise
+        except FetchError as e:
+            # An outage of the source's site, the traceback would say nothing new
+            log.warning(f"Polling {source.name} failed: {e}")
+            changed = None
+        except Exception:
+            log.exception(f"Polling {source.name} failed")
+            changed = None
+        finally:
+            source.running = False
+            self._running.pop(source.name, None)
+        source.runs += 1
+        source.last_duration = time.perf_counter() - started
+        source.adapt(changed)
+        log.debug(f"Polled {source.name} in {source.last_duration:.2f}s ({source.last_state}), "
+                  f"next in {source.next_run - time.monotonic():.0f}s")
+        self._wakeup.set()
+
+    def describe(self) -> List[Dict[str, object]]:
+        """A row per source for the inspect command, soonest first"""
+        now = time.monotonic()
+        rows = []
+        for source in sorted(self.sources.values(), key=lambda s: s.next_run):
+            rows.append({
+                'name': source.name,
+                'state': 'running' if source.running else source.last_state,
+                'interval': source.interval,
+                'next_in': max(0.0, source.next_run - now),
+                'runs': source.runs,
+                'changes': source.changes,
+                'failures': source.failures,
+                'last_duration': source.last_duration,
+                'backoff': source.backing_off,
+            })
+        return rows
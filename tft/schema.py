@@ -1,40 +1,116 @@
-from dataclasses import dataclass
-from typing import List, Union, Optional
+import math
+import re
+from array import array
+from dataclasses import dataclass, fields
+from functools import lru_cache
+from operator import attrgetter
+from typing import List, Union, Optional, Tuple, Callable, Any, Iterable, Dict, Iterator
+
+number_pattern = re.compile(r"-?\d+(?:\.\d+)?")
+
+
+def parse_number(value: Union[str, int, float, None]) -> Optional[float]:
+    """Turns a display value such as "12.5%", "$1,234.56" or "-$40" into a float.
+    Returns None when there is no number in it"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    text = value.replace(',', '')
+    match = number_pattern.search(text)
+    if match is None:
+        return None
+    number = float(match.group(0))
+    if number > 0 and text.strip().startswith('-'):
+        # "-$40": the sign comes before the currency symbol
+        number = -number
+    return number
+
+
+@lru_cache(maxsize=None)
+def _getter(attrs: Tuple[str, ...]) -> Callable[[Any], Tuple[Any, ...]]:
+    get = attrgetter(*attrs)
+    if len(attrs) == 1:
+        # attrgetter returns a bare value for a single attribute
+        return lambda obj: (get(obj),)
+    return get
 
 
 class Flatten:
+    __slots__ = ()
 
     def flatten(self, *attrs) -> List[Union[int, str]]:
-        container = []
-        for attr in attrs:
-            value = getattr(self, attr)
-            if value is not None:
-                container.append(value)
-        return container
+        return [value for value in _getter(attrs)(self) if value is not None]
 
 
 @dataclass
 class LeaderboardEntry(Flatten):
+    __slots__ = ('rank', 'name', 'roi', 'profit')
     rank: int
     name: str
     roi: str
     profit: str
 
 
-    def flatten(self, *attrs) -> List[Union[int, str]]:
-        container = []
-        for attr in attrs:
-            value = getattr(self, attr)
-            if value is not None:
-                container.append(value)
-        return container
-
-
 @dataclass
 class CompetitionEntry(Flatten):
+    __slots__ = ('rank', 'name', 'roi', 'back', 'prize')
     rank: int
     name: str
     roi: str
     back: str
     prize: str
 
+
+class EntryBatch:
+    """Column oriented storage for a large set of entries, such as the full competition field.
+
+    Ranks and the parsed numbers live in typed arrays next to the display strings, so sorting, filtering and
+    statistics work on machine floats without parsing strings again. Missing numbers are stored as NaN, and
+    columns the entry type does not have (profit for a competition) are left empty. Indexing a batch gives back
+    a regular entry.
+    """
+    __slots__ = ('kind', 'ranks', 'names', 'display', 'roi', 'profit', 'back', 'prize')
+
+    numeric_columns = ('roi', 'profit', 'back', 'prize')
+
+    def __init__(self, entries: Iterable[Union[LeaderboardEntry, CompetitionEntry]]):
+        entries = list(entries)
+        self.kind = type(entries[0]) if entries else CompetitionEntry
+        display_columns = [f.name for f in fields(self.kind) if f.name not in ('rank', 'name')]
+        self.ranks = array('l', (entry.rank for entry in entries))
+        self.names: List[str] = [entry.name for entry in entries]
+        # column name -> display strings, in entry order
+        self.display: Dict[str, List[str]] = {
+            column: [getattr(entry, column) for entry in entries] for column in display_columns
+        }
+        for column in self.numeric_columns:
+            values = self.display.get(column)
+            numbers = array('d', (_as_float(value) for value in values) if values else ())
+            setattr(self, column, numbers)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __getitem__(self, index: int) -> Union[LeaderboardEntry, CompetitionEntry]:
+        values = {column: strings[index] for column, strings in self.display.items()}
+        return self.kind(rank=self.ranks[index], name=self.names[index], **values)
+
+    def __iter__(self) -> Iterator[Union[LeaderboardEntry, CompetitionEntry]]:
+        return (self[index] for index in range(len(self)))
+
+    def order_by(self, column: str, descending: bool = True) -> List[int]:
+        """Entry indexes sorted by a numeric column. Missing values sort last"""
+        numbers = getattr(self, column)
+        present = [i for i in range(len(numbers)) if not math.isnan(numbers[i])]
+        present.sort(key=numbers.__getitem__, reverse=descending)
+        return present + [i for i in range(len(numbers)) if math.isnan(numbers[i])]
+
+    def where(self, column: str, minimum: Optional[float] = None, maximum: Optional[float] = None) -> List[int]:
+        """Indexes of the entries whose numeric column falls between minimum and maximum (inclusive)"""
+        low = -math.inf if minimum is None else minimum
+        high = math.inf if maximum is None else maximum
+        return [i for i, value in enumerate(getattr(self, column)) if low <= value <= high]
+
+
+def _as_float(value: Union[str, int, float, None]) -> float:
+    number = parse_number(value)
+    return math.nan if number is None else number
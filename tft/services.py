@@ -1,26 +1,66 @@
-import asyncio
+import codecs
+import copy
+import dataclasses
+import hashlib
+import json
 import re
 import textwrap
 import calendar
+from collections import OrderedDict
 from datetime import timedelta, datetime, timezone
-from typing import List, Optional
+from html.parser import HTMLParser
+from typing import List, Optional, Dict, Iterable, Set, Sequence, Union, TYPE_CHECKING
 
 import aiohttp
 import discord
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer, FeatureNotFound
 from dateutil.relativedelta import relativedelta
 from tabulate import simple_separated_format, tabulate
 import logging
 
 log = logging.getLogger(__name__
                         )
+from tft.deltas import Movement
+from tft.http import RetryPolicy, DEFAULT_RETRY_POLICY, call_with_policy
 from tft.schema import LeaderboardEntry, CompetitionEntry
 
+if TYPE_CHECKING:
+    # tft.stats needs numpy, which only !compstats uses
+    from tft.stats import CompetitionStats
+
 id_pattern = re.compile(r".*/(\d+)")
 
+# BeautifulSoup tree builders that can be selected with set_parser_backend.
+# lxml is several times faster than the pure Python html.parser. The two build different trees for some broken
+# markup (an unclosed <td> swallows the rest of the page under html.parser), so check new pages with both.
+PARSER_BACKENDS = ('html.parser', 'lxml', 'html5lib')
+_parser_backend = 'html.parser'
+
+
+def set_parser_backend(backend: str) -> str:
+    """Selects the tree builder used by every parser in this module.
+    Falls back to html.parser when the requested backend is not installed. Returns the backend in use."""
+    global _parser_backend
+    if backend not in PARSER_BACKENDS:
+        raise ValueError(f"Unknown HTML parser backend {backend}. Choose one of {', '.join(PARSER_BACKENDS)}")
+    try:
+        BeautifulSoup("", backend)
+    except FeatureNotFound:
+        log.warning(f"HTML parser backend {backend} is not installed. Using html.parser")
+        backend = 'html.parser'
+    _parser_backend = backend
+    log.info(f"Using {backend} to parse HTML")
+    return backend
+
+
+def parse_with_soup(html: str, parse_only: Optional[SoupStrainer] = None) -> BeautifulSoup:
+    return BeautifulSoup(html, _parser_backend, parse_only=parse_only)
+
+
 def parse_leaderboard(html: str) -> List[LeaderboardEntry]:
     container = []
-    soup = BeautifulSoup(html, 'html.parser')
+    # Only the table cells are needed, so skip building the rest of the tree
+    soup = parse_with_soup(html, parse_only=SoupStrainer("td"))
     # group by 4 which relates to the leaderboard
     rows = list(zip(*[iter(soup("td"))]*4))
 
@@ -39,7 +79,7 @@ def parse_leaderboard(html: str) -> List[LeaderboardEntry]:
 
 
 def find_active_competition(html: str) -> Optional[int]:
-    soup = BeautifulSoup(html, 'html.parser')
+    soup = parse_with_soup(html)
     for item in soup(class_='contest-list_item'):
         status = item.find_next(class_='contest-list_item__label')
         if status is not None and status.text.lower() == 'in progress':
@@ -57,6 +97,126 @@ def get_competition_label(soup: BeautifulSoup, label: str) -> Optional[str]:
             value = item.find_next(class_='label_background-block')
             return value and value.text.strip()
 
+
+class _Capture:
+    """Text of one element the extractor is reading, and the tags opened inside it that are still open"""
+    __slots__ = ('open', 'text', 'done')
+
+    def __init__(self, tag: Optional[str]):
+        self.open: List[str] = [tag] if tag is not None else []
+        self.text: List[str] = []
+        self.done = tag is None
+
+
+class _LabelLookup:
+    """One ``label`` element and the first title and value elements that start after it"""
+    __slots__ = ('title', 'value')
+
+    def __init__(self):
+        self.title: Optional[_Capture] = None
+        self.value: Optional[_Capture] = None
+
+
+class CompetitionLabelExtractor(HTMLParser):
+    """Incremental parser that pulls label values off the competition details page.
+
+    Reads labels the same way get_competition_label does on a full soup: for every ``label`` element in document
+    order, the first ``label_title`` after it names the label and the first ``label_background-block`` after it
+    holds the value, and the first label with a given title wins. This parser sees the markup chunk by chunk,
+    keeps no tree and collects every wanted label in a single pass.
+    """
+    VOID_ELEMENTS = {
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input',
+        'link', 'meta', 'param', 'source', 'track', 'wbr'
+    }
+
+    def __init__(self, labels: Iterable[str]):
+        super(CompetitionLabelExtractor, self).__init__(convert_charrefs=True)
+        self.wanted: Set[str] = {label.lower() for label in labels}
+        self.found: Dict[str, str] = {}
+        # Label elements whose title or value has not been read yet, in document order
+        self._lookups: List[_LabelLookup] = []
+        self._captures: List[_Capture] = []
+
+    @property
+    def done(self) -> bool:
+        return self.wanted.issubset(self.found.keys())
+
+    def handle_starttag(self, tag, attrs):
+        void = tag in self.VOID_ELEMENTS
+        if not void:
+            for capture in self._captures:
+                capture.open.append(tag)
+        classes = set()
+        for name, value in attrs:
+            if name == 'class' and value:
+                classes.update(value.split())
+        for kind, class_name in (('title', 'label_title'), ('value', 'label_background-block')):
+            if class_name not in classes:
+                continue
+            waiting = [lookup for lookup in self._lookups if getattr(lookup, kind) is None]
+            if not waiting:
+                continue
+            capture = _Capture(None if void else tag)
+            for lookup in waiting:
+                setattr(lookup, kind, capture)
+            if not void:
+                self._captures.append(capture)
+        # find_next only looks after the label element, so it cannot be its own title
+        if 'label' in classes:
+            self._lookups.append(_LabelLookup())
+        self._resolve()
+
+    def handle_endtag(self, tag):
+        for capture in self._captures:
+            if tag in capture.open:
+                # Tags left unclosed inside the element are closed along with it, the same as a tree builder does
+                del capture.open[len(capture.open) - 1 - capture.open[::-1].index(tag):]
+                capture.done = not capture.open
+        self._captures = [capture for capture in self._captures if not capture.done]
+        self._resolve()
+
+    def handle_data(self, data):
+        for capture in self._captures:
+            capture.text.append(data)
+
+    def _resolve(self):
+        """Settles label elements in document order once their title, and if it is wanted their value, is read"""
+        while self._lookups:
+            lookup = self._lookups[0]
+            if lookup.title is None or not lookup.title.done:
+                return
+            label = ''.join(lookup.title.text).lower()
+            if label in self.wanted and label not in self.found:
+                if lookup.value is None or not lookup.value.done:
+                    return
+                self.found[label] = ''.join(lookup.value.text).strip()
+            self._lookups.pop(0)
+
+
+async def read_competition_labels(
+        response: aiohttp.ClientResponse,
+        labels: Iterable[str],
+        chunk_size: int = 16384
+) -> Dict[str, Optional[str]]:
+    """Feeds a competition details response through CompetitionLabelExtractor.
+    The connection is closed as soon as every label has been found, so the rest of the page is never downloaded.
+    Labels that could not be found map to None."""
+    labels = tuple(labels)
+    extractor = CompetitionLabelExtractor(labels)
+    decoder = codecs.getincrementaldecoder(response.charset or 'utf-8')(errors='replace')
+    async for chunk in response.content.iter_chunked(chunk_size):
+        extractor.feed(decoder.decode(chunk))
+        if extractor.done:
+            log.debug(f"Found all labels in {response.url}. Closing the connection early")
+            response.close()
+            break
+    else:
+        extractor.feed(decoder.decode(b'', final=True))
+        extractor.close()
+    return {label: extractor.found.get(label.lower()) for label in labels}
+
+
 def parse_competition(soup: BeautifulSoup):
     container = []
     for item in soup(id='leaderboardBody'):
@@ -79,34 +239,51 @@ def parse_competition(soup: BeautifulSoup):
         return container
 
 
-async def fetch_page_source(url, logger=None):
-    """Polls the TFT Website and gets the html response"""
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url) as response:
-                data = await response.text()
-                return data
-    except Exception:
-        # The site didn't respond. Wait two minutes and try again
-        if logger:
-            logger.error(f"Bad response from {url}. Retrying in 2 minutes")
-        await asyncio.sleep(120)
-        await fetch_page_source(url, logger)
-
-
-def parse_with_soup(html: str) -> BeautifulSoup:
-    return BeautifulSoup(html, 'html.parser')
-
-def make_leaderboard_embed(entries: List[LeaderboardEntry]) -> discord.Embed:
+async def fetch_page_source(session: aiohttp.ClientSession, url, policy: RetryPolicy = DEFAULT_RETRY_POLICY) -> str:
+    """Polls the TFT Website and gets the html response.
+    Raises FetchError when the site could not be reached within the retry policy"""
+    async def request():
+        async with session.get(url) as response:
+            response.raise_for_status()
+            return await response.text()
+    return await call_with_policy(url, request, policy)
+
+def _with_movements(values: List[List[Union[int, str]]], movements: Optional[Sequence[Movement]]):
+    """Appends the movement arrow of each row as an extra column"""
+    if movements is None:
+        return values
+    arrows = {m.name: m.arrow for m in movements}
+    return [row + [arrows.get(row[1], "")] for row in values]
+
+
+def render_leaderboard_table(entries: List[LeaderboardEntry], movements: Optional[Sequence[Movement]] = None) -> str:
+    """Renders the leaderboard table. This is plain data so it can be built off the event loop"""
     header = ["Rank", "Nickname", "Return"]
     attrs = ('rank', 'name', 'roi')
-    today = datetime.now(timezone.utc)
-    month_name = calendar.month_name[today.month]
-    values = [ent.flatten(*attrs) for ent in entries]
+    values = _with_movements([ent.flatten(*attrs) for ent in entries], movements)
+    if movements is not None:
+        header.append("")
     tablefmt = simple_separated_format('      ')
     table = tabulate(values, headers=header, colalign=("center",), tablefmt=tablefmt)
+    return markdown_syntax("css", table)
+
+
+def render_competition_table(entries: List[CompetitionEntry], movements: Optional[Sequence[Movement]] = None) -> str:
+    """Renders the competition table. This is plain data so it can be built off the event loop"""
+    header = ["Rank", "Nickname", "Return"]
+    attrs = ('rank', 'name', 'roi')
+    values = _with_movements([ent.flatten(*attrs) for ent in entries], movements)
+    if movements is not None:
+        header.append("")
+    tablefmt = simple_separated_format('   ')
+    table = tabulate(values, headers=header, colalign=("center",), tablefmt=tablefmt)
+    return markdown_syntax("css", table)
+
+
+def make_leaderboard_embed(entries: List[LeaderboardEntry], table: Optional[str] = None) -> discord.Embed:
+    if table is None:
+        table = render_leaderboard_table(entries)
     leader = markdown_syntax("fix", entries[0].name)
-    table = markdown_syntax("css", table)
     embed = discord.Embed(title=f"The Funded Trader Leaderboard", description=table)
     embed.set_image(url='https://leaderboard.thefundedtraderprogram.com/images/TFT_Logo_Small.png')
     embed.add_field(name=":trophy: Current Leader", value=leader, inline=False)
@@ -114,33 +291,143 @@ def make_leaderboard_embed(entries: List[LeaderboardEntry]) -> discord.Embed:
     embed.timestamp = datetime.now(timezone.utc)
     return embed
 
-def make_competition_embed(entries: List[CompetitionEntry], pool, contestants) -> discord.Embed:
-    header = ["Rank", "Nickname", "Return"]
-    attrs = ('rank', 'name', 'roi')
+TIME_REMAINING_FIELD = ":clock1: Time Remaining"
+
+
+def time_remaining(now: Optional[datetime] = None) -> str:
+    """Time left in the monthly competition, formatted for the embed field"""
+    now = now or datetime.now(timezone.utc)
+    remaining = friendly_time_delta(last_day_of_month(now) - now)
+    return markdown_syntax("fix", remaining or "Last Day")
+
+
+def patch_time_remaining(embed: discord.Embed) -> discord.Embed:
+    """Refreshes the Time Remaining field of a competition embed in place"""
+    for index, field in enumerate(embed.fields):
+        if field.name == TIME_REMAINING_FIELD:
+            embed.set_field_at(index, name=field.name, value=time_remaining(), inline=field.inline)
+    return embed
+
+
+def make_competition_embed(
+        entries: List[CompetitionEntry],
+        pool,
+        contestants,
+        table: Optional[str] = None
+) -> discord.Embed:
+    if table is None:
+        table = render_competition_table(entries)
     today = datetime.now(timezone.utc)
     month_name = calendar.month_name[today.month]
-    values = [ent.flatten(*attrs) for ent in entries]
-    tablefmt = simple_separated_format('   ')
-    table = tabulate(values, headers=header, colalign=("center",), tablefmt=tablefmt)
-    table = markdown_syntax("css", table)
     embed = discord.Embed(title=f"The {month_name} Competition", description=table)
     embed.set_image(url='https://leaderboard.thefundedtraderprogram.com/images/TFT_Logo_Small.png')
 
-    today = datetime.now(timezone.utc)
-    td = last_day_of_month(today) - today
-    remaining = friendly_time_delta(td)
-    remaining = markdown_syntax("fix", remaining or "Last Day")
     pool = markdown_syntax("fix", pool)
     contestants = markdown_syntax("fix", contestants)
     leader = markdown_syntax("fix", entries[0].name)
     embed.add_field(name=":trophy: Current Leader", value=leader, inline=False)
     embed.add_field(name=":moneybag: Prize Pool", value=pool, inline=False)
-    embed.add_field(name=":clock1: Time Remaining", value=remaining, inline=False)
+    embed.add_field(name=TIME_REMAINING_FIELD, value=time_remaining(), inline=False)
     embed.add_field(name=":people_hugging: Remaining Contestants", value=contestants, inline=False)
 
     embed.timestamp = datetime.now(timezone.utc)
     return embed
 
+def make_movers_embed(title: str, movements: Sequence[Movement], limit: int = 25) -> discord.Embed:
+    """Lists only the entries whose rank or return changed since the previous poll"""
+    movers = [m for m in movements if m.changed][:limit]
+    lines = []
+    for m in movers:
+        roi = f"{m.roi:g}%" if m.roi is not None else "?"
+        if m.is_new:
+            lines.append(f"NEW #{m.rank} {m.name} ({roi})")
+        else:
+            previous_roi = f"{m.previous_roi:g}%" if m.previous_roi is not None else "?"
+            arrow = m.arrow or "="
+            lines.append(f"{arrow} #{m.rank} {m.name} ({previous_roi} -> {roi})")
+    description = markdown_syntax("css", "\n".join(lines)) if lines else "No movement since the last update."
+    embed = discord.Embed(title=title, description=description)
+    embed.timestamp = datetime.now(timezone.utc)
+    return embed
+
+
+def make_compstats_embed(stats: 'CompetitionStats') -> discord.Embed:
+    """Describes the return distribution of the whole competition field"""
+    percentiles = tabulate(
+        [[f"P{p}", f"{value:.2f}%"] for p, value in stats.percentiles],
+        tablefmt=simple_separated_format('   ')
+    )
+    buckets = []
+    for (low, high), count in stats.histogram:
+        if low == float('-inf'):
+            label = f"< {high:g}%"
+        elif high == float('inf'):
+            label = f">= {low:g}%"
+        else:
+            label = f"{low:g}% to {high:g}%"
+        buckets.append([label, count])
+    histogram = tabulate(buckets, tablefmt=simple_separated_format('   '), colalign=("right",))
+    embed = discord.Embed(title="Competition Statistics", description=markdown_syntax("css", histogram))
+    embed.add_field(name=":bar_chart: Return Percentiles", value=markdown_syntax("css", percentiles), inline=False)
+    split = f"{stats.positive:.1%} positive, {stats.negative:.1%} negative, mean {stats.mean:.2f}%"
+    embed.add_field(name=":scales: Field", value=markdown_syntax("fix", split), inline=False)
+    if stats.prize_cutoff_rank is not None:
+        roi = f"{stats.prize_cutoff_roi:.2f}%" if stats.prize_cutoff_roi is not None else "?"
+        cutoff = f"Rank {stats.prize_cutoff_rank} at {roi}"
+        embed.add_field(name=":moneybag: Prize Cutoff", value=markdown_syntax("fix", cutoff), inline=False)
+    embed.set_footer(text=f"{stats.counted} of {stats.contestants} contestants")
+    embed.timestamp = datetime.now(timezone.utc)
+    return embed
+
+
+def embed_fingerprint(embed: discord.Embed) -> str:
+    """Hashes what an embed displays: title, description, fields, image and footer.
+    The timestamp is left out so re-rendering identical data produces the same fingerprint."""
+    payload = embed.to_dict()
+    payload.pop('timestamp', None)
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class EmbedCache:
+    """LRU cache of rendered embeds keyed by a hash of the entries and the options they were rendered with.
+
+    Embeds are stored as payload dicts without their timestamp. get() builds a fresh embed from the payload and
+    stamps it with the current time; anything else that depends on the clock is left to the caller to patch in.
+    """
+    def __init__(self, maxsize: int = 16):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._payloads: OrderedDict[str, dict] = OrderedDict()
+
+    @staticmethod
+    def key(kind: str, entries: Sequence[Union[LeaderboardEntry, CompetitionEntry]], *options) -> str:
+        """Hashes the entries and any formatting options (movements, footer, labels) into a cache key"""
+        rows = [dataclasses.astuple(entry) for entry in entries]
+        blob = json.dumps([kind, rows, options], default=str)
+        return hashlib.sha256(blob.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[discord.Embed]:
+        payload = self._payloads.get(key)
+        if payload is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._payloads.move_to_end(key)
+        # The embed keeps references to the nested field dicts, so give it its own copy to patch
+        embed = discord.Embed.from_dict(copy.deepcopy(payload))
+        embed.timestamp = datetime.now(timezone.utc)
+        return embed
+
+    def put(self, key: str, embed: discord.Embed):
+        payload = embed.to_dict()
+        payload.pop('timestamp', None)
+        self._payloads[key] = payload
+        self._payloads.move_to_end(key)
+        while len(self._payloads) > self.maxsize:
+            self._payloads.popitem(last=False)
+
+
 def friendly_time_delta(td: timedelta):
     """
     Taken from https://stackoverflow.com/questions/538666/format-timedelta-to-string
@@ -0,0 +1,61 @@
+from typing import NamedTuple, Optional, Tuple
+
+import numpy as np
+
+from tft.schema import EntryBatch
+
+PERCENTILES = (10, 25, 50, 75, 90, 99)
+# Edges of the return histogram, in percent. The outer buckets are open ended.
+HISTOGRAM_EDGES = (-100.0, -20.0, -10.0, -5.0, 0.0, 5.0, 10.0, 20.0, 50.0)
+
+
+class CompetitionStats(NamedTuple):
+    contestants: int
+    # Contestants with a return we could parse
+    counted: int
+    percentiles: Tuple[Tuple[int, float], ...]
+    # ((low, high), count) for every histogram bucket
+    histogram: Tuple[Tuple[Tuple[float, float], int], ...]
+    positive: float
+    negative: float
+    mean: float
+    # Rank and return of the last contestant that currently wins a prize
+    prize_cutoff_rank: Optional[int]
+    prize_cutoff_roi: Optional[float]
+
+
+def compute_competition_stats(batch: EntryBatch) -> Optional[CompetitionStats]:
+    """Summarises the return distribution of the whole field. Returns None when no return could be parsed"""
+    roi = np.asarray(batch.roi, dtype=np.float64)
+    known = roi[~np.isnan(roi)]
+    if known.size == 0:
+        return None
+
+    values = np.percentile(known, PERCENTILES)
+    edges = np.array((-np.inf,) + HISTOGRAM_EDGES + (np.inf,))
+    # Bucket i holds edges[i] <= roi < edges[i + 1]
+    counts = np.bincount(np.searchsorted(HISTOGRAM_EDGES, known, side='right'), minlength=len(edges) - 1)
+
+    cutoff_rank = cutoff_roi = None
+    prize = np.asarray(batch.prize, dtype=np.float64)
+    if prize.size:
+        winners = np.flatnonzero(prize > 0)
+        if winners.size:
+            ranks = np.asarray(batch.ranks)
+            last = winners[np.argmax(ranks[winners])]
+            cutoff_rank = int(ranks[last])
+            cutoff_roi = None if np.isnan(roi[last]) else float(roi[last])
+
+    return CompetitionStats(
+        contestants=len(batch),
+        counted=int(known.size),
+        percentiles=tuple((p, float(v)) for p, v in zip(PERCENTILES, values)),
+        histogram=tuple(
+            ((float(low), float(high)), int(count)) for low, high, count in zip(edges[:-1], edges[1:], counts)
+        ),
+        positive=float(np.count_nonzero(known > 0)) / known.size,
+        negative=float(np.count_nonzero(known < 0)) / known.size,
+        mean=float(known.mean()),
+        prize_cutoff_rank=cutoff_rank,
+        prize_cutoff_roi=cutoff_roi,
+    )